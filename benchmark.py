@@ -0,0 +1,244 @@
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import librosa
+import numpy as np
+import soundfile as sf
+
+from fingerprint_index import FEATURE_KEYS, INDEX_FILENAME, FingerprintIndex
+from generate_spectrogram import SpectrogramGenerator
+from ivf_index import IVF_MIN_TRACKS, build_ivf_index
+from perceptual_code import REFERENCE_CENTER, REFERENCE_SCALE, perceptual_code
+from recognition import Recognizer
+from similarity import top_k_indices
+
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_NPROBES = [8, 16, 32]
+AUDIO_KINDS = ["tone", "chirp", "noise_mix"]
+AUDIO_SAMPLE_RATE = 44100
+
+
+def synthetic_audio(kind, duration=30.0, sr=AUDIO_SAMPLE_RATE, seed=0):
+    """
+    Deterministic test signal, float32 in [-1, 1].
+    :param kind: "tone" (a few harmonics), "chirp" (log sweep over the audible range)
+                 or "noise_mix" (tones in white and low-passed noise).
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sr)) / sr
+    if kind == "tone":
+        f0 = rng.uniform(110, 440)
+        y = sum(np.sin(2 * np.pi * f0 * h * t) / h for h in range(1, 6))
+    elif kind == "chirp":
+        y = librosa.chirp(fmin=40, fmax=sr / 4, sr=sr, duration=duration)[:len(t)]
+    elif kind == "noise_mix":
+        white = rng.standard_normal(len(t))
+        low = np.convolve(rng.standard_normal(len(t)), np.ones(32) / 32, "same")
+        tones = sum(np.sin(2 * np.pi * rng.uniform(80, 2000) * t) for _ in range(4))
+        y = tones + 0.5 * white + 4 * low
+    else:
+        raise ValueError(f"Unknown synthetic audio kind: {kind}")
+    return (y / np.max(np.abs(y))).astype(np.float32)
+
+
+def synthetic_features(size, seed=0):
+    """(size, len(FEATURE_KEYS)) float32 feature matrix spread like a real catalog."""
+    rng = np.random.default_rng(seed)
+    features = rng.normal(REFERENCE_CENTER, REFERENCE_SCALE * 0.5, size=(size, len(FEATURE_KEYS)))
+    # Amplitude spectrograms never cross zero: the real catalog has a constant zero rate.
+    features[:, FEATURE_KEYS.index("zero_crossing_rate_mean")] = 0.0
+    return features.astype(np.float32)
+
+
+def synthetic_catalog(size, seed=0):
+    """FingerprintIndex of `size` synthetic tracks named synthetic_0000000, synthetic_0000001, ..."""
+    features = synthetic_features(size, seed)
+    names = np.char.mod("synthetic_%07d", np.arange(size)).astype("S17")
+    table = np.zeros(size, dtype=FingerprintIndex.dtype(17))
+    table["name"] = names
+    table["features"] = features
+    table["phash"] = perceptual_code(features.astype(np.float64))
+    return FingerprintIndex(table)
+
+
+def time_call(fn, repeat):
+    """
+    Run fn `repeat` times.
+    :return: (stats in milliseconds, result of the last call)
+    """
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return summarize(samples), result
+
+
+def summarize(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    return {
+        "median_ms": float(np.median(samples)),
+        "min_ms": float(np.min(samples)),
+        "mean_ms": float(np.mean(samples)),
+        "repeat": len(samples),
+    }
+
+
+def bench_audio(generator, kind, duration, repeat, directory):
+    """Time every analysis stage of one synthetic file, from decoding to its perceptual code."""
+    path = os.path.join(directory, f"{kind}.wav")
+    sf.write(path, synthetic_audio(kind, duration), AUDIO_SAMPLE_RATE)
+
+    stages = {}
+    stages["decode"], (y, sr) = time_call(lambda: generator.load_audio(path), repeat)
+    stages["mel_spectrogram"], S = time_call(lambda: librosa.feature.melspectrogram(y=y, sr=sr), repeat)
+    stages["power_to_db"], S_DB = time_call(lambda: generator.spectrogram_from_power(S), repeat)
+
+    feature_samples = {}
+    extract_samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        features = generator.feature_engine.extract(S_DB)
+        extract_samples.append((time.perf_counter() - start) * 1000)
+        for name, seconds in generator.feature_engine.timings.items():
+            feature_samples.setdefault(name, []).append(seconds * 1000)
+    stages["features"] = summarize(extract_samples)
+    for name, samples in feature_samples.items():
+        stages[f"features.{name}"] = summarize(samples)
+
+    stages["hashing"], _ = time_call(lambda: generator.perceptual_hash(features), repeat)
+    stages["landmarks"], _ = time_call(lambda: generator.landmark_fingerprint(y, sr), repeat)
+    return {"duration_s": duration, "sample_rate": sr, "stages": stages}
+
+
+def bench_catalog(size, repeat, top_k, directory, ivf=False, queries=20, nprobes=DEFAULT_NPROBES):
+    """
+    Time loading and querying a synthetic catalog of `size` tracks.
+    Queries are perturbed catalog entries, so that they have a true nearest neighbour.
+    With an IVF index, every nprobe is also timed and its recall@top_k measured
+    against the exhaustive top_k.
+    """
+    build_start = time.perf_counter()
+    index = synthetic_catalog(size)
+    index.save(os.path.join(directory, INDEX_FILENAME))
+    if ivf and size >= IVF_MIN_TRACKS:
+        build_ivf_index(directory, index)
+    build_seconds = time.perf_counter() - build_start
+
+    generator = SpectrogramGenerator(None)
+    generator.output_path = directory
+
+    def load():
+        recognizer = Recognizer(generator, nprobe=None)
+        recognizer.scorer
+        return recognizer
+
+    stages = {}
+    stages["index_load"], recognizer = time_call(load, repeat)
+
+    rng = np.random.default_rng(1)
+    rows = rng.choice(size, size=min(queries, size), replace=False)
+    query_vectors = np.asarray(index.features[rows], dtype=np.float64)
+    query_vectors *= rng.normal(1, 0.02, size=query_vectors.shape)
+    query_codes = perceptual_code(query_vectors)
+    fingerprints = [{"features": dict(zip(FEATURE_KEYS, map(float, v)))} for v in query_vectors]
+
+    scoring, ranking, search = [], [], []
+    exact = [{name for name, _ in recognizer.find_similar_songs(fingerprint, top_k)} for fingerprint in fingerprints]
+    for _ in range(repeat):
+        for vector, code in zip(query_vectors, query_codes):
+            start = time.perf_counter()
+            scores = recognizer.scorer.score(vector, code)
+            scoring.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            top_k_indices(scores, top_k)
+            ranking.append((time.perf_counter() - start) * 1000)
+        for fingerprint in fingerprints:
+            start = time.perf_counter()
+            recognizer.find_similar_songs(fingerprint, top_k)
+            search.append((time.perf_counter() - start) * 1000)
+    stages["scoring"] = summarize(scoring)
+    stages["ranking"] = summarize(ranking)
+    stages["find_similar_songs"] = summarize(search)
+
+    recall = {}
+    if recognizer.ivf is not None:
+        for nprobe in nprobes:
+            probed = Recognizer(generator, nprobe=nprobe)
+            probed_search, found = [], 0
+            for _ in range(repeat):
+                for fingerprint, truth in zip(fingerprints, exact):
+                    start = time.perf_counter()
+                    matches = probed.find_similar_songs(fingerprint, top_k)
+                    probed_search.append((time.perf_counter() - start) * 1000)
+                    found += len({name for name, _ in matches} & truth)
+            stages[f"find_similar_songs_ivf_{nprobe}"] = summarize(probed_search)
+            recall[str(nprobe)] = found / (repeat * sum(map(len, exact)))
+
+    result = {"size": size, "build_s": build_seconds, "queries": len(rows), "stages": stages}
+    if recall:
+        result[f"ivf_recall_at_{top_k}"] = recall
+    return result
+
+
+def environment():
+    """Where the numbers come from, so that runs on different commits or machines can be told apart."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "librosa": librosa.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(description="Time every recognition stage on synthetic audio and catalogs")
+    parser.add_argument("--sizes", type=int, nargs="*", default=DEFAULT_SIZES, help="Catalog sizes to generate")
+    parser.add_argument("--audio", nargs="*", default=AUDIO_KINDS, choices=AUDIO_KINDS,
+                        help="Synthetic signals to analyze")
+    parser.add_argument("--duration", type=float, default=30.0, help="Length of the synthetic signals (s)")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per stage")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--ivf", action="store_true",
+                        help=f"Also build and query an IVF index for catalogs of {IVF_MIN_TRACKS}+ tracks")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=DEFAULT_NPROBES,
+                        help="IVF clusters probed per query, each timed and checked for recall")
+    parser.add_argument("--output", "-o", default="-", help="JSON report file (default: stdout)")
+    args = parser.parse_args()
+
+    report = {"environment": environment(), "audio": {}, "catalog": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        generator = SpectrogramGenerator(None)
+        for kind in args.audio:
+            print(f"Benchmarking {kind} analysis...", file=sys.stderr)
+            report["audio"][kind] = bench_audio(generator, kind, args.duration, args.repeat, directory)
+
+        for size in args.sizes:
+            print(f"Benchmarking a catalog of {size} tracks...", file=sys.stderr)
+            catalog_dir = os.path.join(directory, f"catalog_{size}")
+            os.makedirs(catalog_dir)
+            report["catalog"][str(size)] = bench_catalog(size, args.repeat, args.top_k, catalog_dir, args.ivf,
+                                                        nprobes=args.nprobe)
+
+    text = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
@@ -0,0 +1,250 @@
+"""
+Accuracy against latency: recognize distorted copies of catalog tracks under several
+recognition configurations.
+
+    python evaluate.py Task_5_Data/ --modes features landmarks --nprobe 0 8 --workers 4
+
+Every catalog track found under the given paths yields one query per variant (excerpts,
+added noise, gain changes, resampling, mixes with another track). Queries are built and
+fingerprinted in a process pool, then ranked in this process by every configuration.
+For each configuration and variant the report gives recall@1, recall@5 and the p50/p95/p99
+latency of fingerprinting plus search (decoding and distortion are not counted).
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import soxr
+
+from generate_spectrogram import BASE_DIR, SpectrogramGenerator, bounded_map
+from landmarks import load_landmark_index
+from mixer import mix_streams
+from recognition import Recognizer, fingerprint_audio
+from recognize import find_audio_files
+
+
+def excerpt(duration):
+    """A random `duration` seconds of the analysis window."""
+    def distort(y, sr, rng):
+        length = int(duration * sr)
+        start = int(rng.integers(0, max(len(y) - length, 0) + 1))
+        return y[start:start + length], sr
+    return distort
+
+
+def add_noise(snr_db):
+    """White noise at snr_db below the signal's power."""
+    def distort(y, sr, rng):
+        power = float(np.mean(y.astype(np.float64) ** 2))
+        noise = rng.standard_normal(len(y)) * np.sqrt(power / 10 ** (snr_db / 10))
+        return (y + noise).astype(np.float32), sr
+    return distort
+
+
+def gain(db):
+    """Gain change, clipped to [-1, 1] like a fixed-point export would."""
+    def distort(y, sr, rng):
+        return np.clip(y * 10 ** (db / 20), -1, 1).astype(np.float32), sr
+    return distort
+
+
+def resample(target_sr):
+    """Resampled to target_sr, the query keeping the lower rate."""
+    def distort(y, sr, rng):
+        if sr <= target_sr:
+            return y, sr
+        return soxr.resample(y, sr, target_sr, quality="HQ").astype(np.float32), target_sr
+    return distort
+
+
+VARIANTS = {
+    "clean": lambda y, sr, rng: (y, sr),
+    "excerpt_10s": excerpt(10.0),
+    "excerpt_5s": excerpt(5.0),
+    "noise_20db": add_noise(20),
+    "noise_10db": add_noise(10),
+    "noise_5db": add_noise(5),
+    "noise_0db": add_noise(0),
+    "gain_-12db": gain(-12),
+    "gain_+6db": gain(6),
+    "resample_16k": resample(16000),
+    "resample_8k": resample(8000),
+}
+# Mixes made by the mixer, the catalog track weighted by the ratio: it should still come first.
+MIX_RATIOS = {"mix_80": 0.8, "mix_60": 0.6}
+ALL_VARIANTS = list(VARIANTS) + list(MIX_RATIOS)
+
+
+def make_query(generator, file_path, variant, seed, partner_path=None):
+    """Decoded and distorted analysis window of a catalog file: (y, sr)."""
+    rng = np.random.default_rng(seed)
+    if variant in MIX_RATIOS:
+        sr, blocks = mix_streams(file_path, partner_path, MIX_RATIOS[variant],
+                                 generator.offset, generator.duration)
+        y = np.concatenate([np.zeros(0, dtype=np.float32), *blocks])
+        # Mixes are peak-normalized before recognition, as in Recognizer.rank_stream.
+        peak = float(np.max(np.abs(y), initial=0.0))
+        return (y / peak if peak > 0 else y), sr
+    y, sr = generator.load_audio(file_path)
+    return VARIANTS[variant](y, sr, rng)
+
+
+def _query_fingerprint(generator, landmarks, file_path, variant, seed, partner_path):
+    """Worker entry point: errors are returned so that one bad file does not stop the run."""
+    try:
+        y, sr = make_query(generator, file_path, variant, seed, partner_path)
+        start = time.perf_counter()
+        fingerprint = fingerprint_audio(generator, y, sr, landmarks)
+        return file_path, variant, fingerprint, time.perf_counter() - start
+    except Exception as e:
+        return file_path, variant, e, None
+
+
+def summarize(ranks, latencies, errors):
+    """
+    :param ranks: Rank of the expected track in every answered query (None if not in the top 5).
+    :param latencies: Seconds per answered query.
+    """
+    ranks = list(ranks)
+    latencies_ms = np.asarray(latencies, dtype=np.float64) * 1000
+    summary = {
+        "queries": len(ranks),
+        "errors": errors,
+        "recall@1": sum(rank == 1 for rank in ranks) / len(ranks) if ranks else None,
+        "recall@5": sum(rank is not None for rank in ranks) / len(ranks) if ranks else None,
+    }
+    for q in (50, 95, 99):
+        summary[f"p{q}_ms"] = float(np.percentile(latencies_ms, q)) if len(latencies_ms) else None
+    return summary
+
+
+def evaluate(configurations, files, variants=ALL_VARIANTS, workers=None, seed=0):
+    """
+    Recognize every variant of every file with every configuration.
+    :param configurations: {name: Recognizer}. All must share a generator and a catalog.
+    :param files: Audio files of catalog tracks, whose catalog name is their file name.
+    :return: {configuration name: {variant: summary, ..., "all": summary}}
+    """
+    workers = workers or os.cpu_count() or 1
+    generator = next(iter(configurations.values())).generator
+
+    outcomes = {name: {variant: {"ranks": [], "latencies": [], "errors": 0} for variant in variants}
+                for name in configurations}
+    by_fingerprint_kind = {}
+    for name, recognizer in configurations.items():
+        recognizer.index
+        if recognizer.match_mode == "landmarks" and not recognizer.uses_landmarks():
+            # It would silently fall back to features and be reported under the wrong name.
+            raise ValueError(f"{name}: the catalog has no landmark index")
+        by_fingerprint_kind.setdefault(recognizer.uses_landmarks(), []).append(name)
+
+    rng = np.random.default_rng(seed)
+    partners = [files[(i + 1 + int(rng.integers(len(files) - 1))) % len(files)] if len(files) > 1 else None
+                for i in range(len(files))]
+    jobs = [(file_path, variant, seed + 1000 * i + j, partner)
+            for i, (file_path, partner) in enumerate(zip(files, partners))
+            for j, variant in enumerate(variants)
+            if partner is not None or variant not in MIX_RATIOS]
+
+    for landmarks, names in by_fingerprint_kind.items():
+        with contextlib.ExitStack() as stack:
+            args = ((generator, landmarks, *job) for job in jobs)
+            if workers == 1:
+                results = (_query_fingerprint(*job) for job in args)
+            else:
+                pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+                results = bounded_map(pool, _query_fingerprint, args, max_pending=2 * workers)
+
+            for file_path, variant, fingerprint, fingerprint_seconds in results:
+                expected = os.path.basename(file_path)
+                for name in names:
+                    outcome = outcomes[name][variant]
+                    if isinstance(fingerprint, Exception):
+                        outcome["errors"] += 1
+                        continue
+                    # Rank directly: the result cache would hide the search cost.
+                    start = time.perf_counter()
+                    top = [match[0] for match in configurations[name].rank(fingerprint)[:5]]
+                    outcome["latencies"].append(fingerprint_seconds + time.perf_counter() - start)
+                    outcome["ranks"].append(top.index(expected) + 1 if expected in top else None)
+
+    report = {}
+    for name, by_variant in outcomes.items():
+        report[name] = {variant: summarize(outcome["ranks"], outcome["latencies"], outcome["errors"])
+                        for variant, outcome in by_variant.items()}
+        report[name]["all"] = summarize([rank for o in by_variant.values() for rank in o["ranks"]],
+                                        [seconds for o in by_variant.values() for seconds in o["latencies"]],
+                                        sum(o["errors"] for o in by_variant.values()))
+    return report
+
+
+def print_report(report, stream=sys.stdout):
+    def fmt(value, pattern):
+        return "-" if value is None else pattern.format(value)
+
+    stream.write(f"{'configuration':<24} {'variant':<14} {'n':>5} {'R@1':>6} {'R@5':>6} "
+                 f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}\n")
+    for name, by_variant in report.items():
+        for variant, s in by_variant.items():
+            stream.write(f"{name:<24} {variant:<14} {s['queries']:>5} {fmt(s['recall@1'], '{:.3f}'):>6} "
+                         f"{fmt(s['recall@5'], '{:.3f}'):>6} {fmt(s['p50_ms'], '{:.1f}'):>8} "
+                         f"{fmt(s['p95_ms'], '{:.1f}'):>8} {fmt(s['p99_ms'], '{:.1f}'):>8}\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure recall and latency on distorted catalog tracks")
+    parser.add_argument("paths", nargs="*", default=[os.path.join(BASE_DIR, "Task_5_Data")],
+                        help="Audio files or directories of catalog tracks")
+    parser.add_argument("--fingerprints", help="Fingerprint folder (default: ./fingerprints)")
+    parser.add_argument("--modes", nargs="+", choices=["features", "landmarks"], default=["features"])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[0],
+                        help="IVF clusters probed per feature query, 0 for an exhaustive scan")
+    parser.add_argument("--variants", nargs="+", choices=ALL_VARIANTS, default=ALL_VARIANTS, metavar="VARIANT",
+                        help=f"Query variants (default: all of {', '.join(ALL_VARIANTS)})")
+    parser.add_argument("--limit", type=int, default=None, help="Evaluate a random sample of this many tracks")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes (default: all cores, 1 to run in-process)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON report file")
+    args = parser.parse_args(argv)
+
+    generator = SpectrogramGenerator(None)
+    if args.fingerprints:
+        generator.output_path = args.fingerprints
+
+    configurations = {}
+    for mode in args.modes:
+        if mode == "landmarks" and load_landmark_index(generator.output_path) is None:
+            print(f"Skipping landmarks: {generator.output_path} has no landmark index "
+                  f"(run generate_spectrogram.py to build it)", file=sys.stderr)
+            continue
+        for nprobe in args.nprobe if mode == "features" else [0]:
+            name = mode if mode == "landmarks" else f"{mode}/nprobe={nprobe or 'all'}"
+            configurations[name] = Recognizer(generator, match_mode=mode, nprobe=nprobe or None)
+    if not configurations:
+        parser.error("no configuration left to evaluate")
+
+    catalog = set(next(iter(configurations.values())).index.names())
+    files = [path for path in find_audio_files(args.paths) if os.path.basename(path) in catalog]
+    if args.limit is not None and args.limit < len(files):
+        rng = np.random.default_rng(args.seed)
+        files = [files[i] for i in sorted(rng.choice(len(files), size=args.limit, replace=False))]
+    if not files:
+        parser.error("no audio file of the catalog found under the given paths")
+    print(f"Evaluating {len(files)} tracks x {len(args.variants)} variants "
+          f"x {len(configurations)} configurations", file=sys.stderr)
+
+    report = evaluate(configurations, files, args.variants, args.workers, args.seed)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+import librosa
+import numpy as np
+
+from tracing import span
+
+
+# extract_features works on mel spectrograms without their sample rate, so, like the
+# librosa feature functions it replaces, every frequency grid assumes librosa's default.
+SAMPLE_RATE = 22050
+N_CHROMA = 12
+N_MFCC = 13
+
+
+@lru_cache(maxsize=None)
+def _frequencies(n_bins):
+    """Center frequency of each bin, the grid librosa infers from an n_bins spectrogram."""
+    freq = librosa.fft_frequencies(sr=SAMPLE_RATE, n_fft=2 * (n_bins - 1))
+    freq.setflags(write=False)
+    return freq
+
+
+@lru_cache(maxsize=128)
+def _chroma_filterbank(n_fft, tuning):
+    chromafb = librosa.filters.chroma(sr=SAMPLE_RATE, n_fft=n_fft, tuning=tuning, n_chroma=N_CHROMA)
+    chromafb.setflags(write=False)
+    return chromafb
+
+
+@lru_cache(maxsize=None)
+def _tonnetz_transform(n_chroma):
+    dim_map = np.linspace(0, 12, num=n_chroma, endpoint=False)
+    scale = np.asarray([7.0 / 6, 7.0 / 6, 3.0 / 2, 3.0 / 2, 2.0 / 3, 2.0 / 3])
+    V = np.multiply.outer(scale, dim_map)
+    V[::2] -= 0.5
+    R = np.array([1, 1, 1, 1, 0.5, 0.5])
+    phi = R[:, np.newaxis] * np.cos(np.pi * V)
+    phi.setflags(write=False)
+    return phi
+
+
+class FeatureEngine:
+    """
+    Summarized features of a dB mel spectrogram, computed in one pass.
+
+    Produces exactly the values of the individual librosa feature calls, but every
+    intermediate (amplitude spectrogram, frequency grid, column-normalized spectrogram,
+    cumulative energy, chroma, filter banks) is computed once and shared. The time
+    spent on each feature by the last extract() call is kept in `timings`.
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        with span(name):
+            yield
+        self.timings[name] = time.perf_counter() - start
+
+    def extract(self, spectrogram, features=None):
+        """
+        :param features: Dict to fill (so that a caller keeps the features computed before an error).
+        """
+        self.timings = {}
+        features = {} if features is None else features
+
+        with self._timed("amplitude"):
+            amplitude = librosa.db_to_amplitude(spectrogram)
+            freq = _frequencies(amplitude.shape[-2])
+            freq_column = freq[:, np.newaxis]
+            normalized = librosa.util.normalize(amplitude, norm=1, axis=-2)
+
+        with self._timed("spectral_centroid"):
+            centroid = np.sum(freq_column * normalized, axis=-2, keepdims=True)
+            features['spectral_centroid_mean'] = float(np.mean(centroid))
+
+        with self._timed("spectral_bandwidth"):
+            deviation = np.abs(np.subtract.outer(centroid[..., 0, :], freq).swapaxes(-2, -1))
+            bandwidth = np.sum(normalized * deviation ** 2, axis=-2, keepdims=True) ** (1.0 / 2)
+            features['spectral_bandwidth_mean'] = float(np.mean(bandwidth))
+
+        with self._timed("spectral_contrast"):
+            contrast = librosa.feature.spectral_contrast(S=amplitude, sr=SAMPLE_RATE, freq=freq)
+            features['spectral_contrast_mean'] = float(np.mean(contrast))
+
+        with self._timed("spectral_rolloff"):
+            total_energy = np.cumsum(amplitude, axis=-2)
+            threshold = np.expand_dims(0.85 * total_energy[..., -1, :], axis=-2)
+            rolloff = np.nanmin(np.where(total_energy < threshold, np.nan, 1) * freq_column,
+                                axis=-2, keepdims=True)
+            features['spectral_rolloff_mean'] = float(np.mean(rolloff))
+
+        with self._timed("chroma"):
+            tuning = librosa.estimate_tuning(S=amplitude, sr=SAMPLE_RATE, bins_per_octave=N_CHROMA)
+            chromafb = _chroma_filterbank(2 * (amplitude.shape[-2] - 1), float(tuning))
+            raw_chroma = np.einsum("cf,...ft->...ct", chromafb, amplitude, optimize=True)
+            chroma = librosa.util.normalize(raw_chroma, norm=np.inf, axis=-2)
+
+        with self._timed("tonnetz"):
+            tonnetz = np.einsum("pc,...ci->...pi", _tonnetz_transform(chroma.shape[-2]),
+                                librosa.util.normalize(chroma, norm=1, axis=-2), optimize=True)
+            features['tonnetz_mean'] = float(np.mean(tonnetz))
+
+        with self._timed("zero_crossing_rate"):
+            if np.all(amplitude >= 0):
+                # An amplitude spectrogram never changes sign, so its rate is exactly zero.
+                features['zero_crossing_rate_mean'] = 0.0
+            else:
+                features['zero_crossing_rate_mean'] = float(np.mean(librosa.feature.zero_crossing_rate(amplitude)))
+
+        with self._timed("mfcc"):
+            mfcc = librosa.get_fftlib().dct(spectrogram, axis=-2, type=2, norm='ortho')[..., :N_MFCC, :]
+            for i in range(mfcc.shape[0]):
+                features[f'mfcc_{i}_mean'] = float(np.mean(mfcc[i, :]))
+
+        return features
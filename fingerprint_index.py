@@ -0,0 +1,162 @@
+import json
+import os
+
+import numpy as np
+
+from metrics import SKIPPED_FINGERPRINTS
+from perceptual_code import CODE_WORDS, code_to_hex, hex_to_code, perceptual_code
+
+
+FEATURE_KEYS = [
+    "spectral_centroid_mean", "spectral_bandwidth_mean", "spectral_contrast_mean",
+    "spectral_rolloff_mean", "tonnetz_mean", "zero_crossing_rate_mean",
+] + [f"mfcc_{i}_mean" for i in range(13)]
+
+INDEX_FILENAME = "index.npy"
+
+
+def features_to_vector(features, dtype=np.float32):
+    """
+    Flatten a feature dict into a row in FEATURE_KEYS order.
+    Missing features are stored as NaN so that scoring can skip them.
+    """
+    return np.array([features.get(key, np.nan) for key in FEATURE_KEYS], dtype=dtype)
+
+
+def fingerprint_code(fingerprint):
+    """
+    Binary perceptual code of a fingerprint dict as uint64 words. Fingerprints written
+    before codes existed carry a SHA-256 phash instead: their code is derived from the features.
+    """
+    code = hex_to_code(fingerprint.get("phash"))
+    if code is None:
+        code = perceptual_code(features_to_vector(fingerprint["features"], np.float64))
+    return code
+
+
+class FingerprintIndex:
+    """
+    Consolidated catalog of fingerprints stored as a single structured .npy file.
+
+    Each row holds the track name (utf-8), the feature vector (float32, FEATURE_KEYS order)
+    and the perceptual code (uint64 words). The file is opened with a memory map so queries
+    only touch one file.
+    """
+
+    def __init__(self, table, path=None):
+        self.table = table
+        self.path = path
+
+    @staticmethod
+    def dtype(name_length):
+        return np.dtype([
+            ("name", f"S{max(name_length, 1)}"),
+            ("features", "<f4", (len(FEATURE_KEYS),)),
+            ("phash", "<u8", (CODE_WORDS,)),
+        ])
+
+    @classmethod
+    def from_fingerprints(cls, items):
+        """
+        Build an in-memory index.
+        :param items: Iterable of (track name, fingerprint dict) pairs.
+        """
+        names, vectors, phashes = [], [], []
+        for name, fingerprint in items:
+            names.append(name.encode("utf-8"))
+            vectors.append(features_to_vector(fingerprint["features"]))
+            phashes.append(fingerprint_code(fingerprint))
+
+        table = np.zeros(len(names), dtype=cls.dtype(max((len(n) for n in names), default=1)))
+        if names:
+            table["name"] = names
+            table["features"] = np.stack(vectors)
+            table["phash"] = np.stack(phashes)
+        return cls(table)
+
+    @classmethod
+    def from_json_dir(cls, directory):
+        """Convert a directory of per-song JSON fingerprints into an index."""
+        def items():
+            for file in sorted(os.listdir(directory)):
+                if not file.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(directory, file), "r") as f:
+                        data = json.load(f)
+                except Exception as e:
+                    print(f"Error reading {file}: {e}")
+                    SKIPPED_FINGERPRINTS.inc(reason="unreadable")
+                    continue
+                if "features" not in data:
+                    print(f"Invalid fingerprint structure in {file}")
+                    SKIPPED_FINGERPRINTS.inc(reason="structure")
+                    continue
+                yield file[:-len(".json")], data
+
+        return cls.from_fingerprints(items())
+
+    @classmethod
+    def is_current_layout(cls, table):
+        """False for indexes written by an older version, which must be rebuilt."""
+        return table.dtype.names == cls.dtype(1).names and table.dtype["phash"] == cls.dtype(1)["phash"]
+
+    @classmethod
+    def open(cls, path):
+        return cls(np.load(path, mmap_mode="r"), path)
+
+    def save(self, path):
+        # Write then rename so that readers never see a half-written index.
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, self.table)
+        os.replace(tmp_path, path)
+        self.path = path
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def features(self):
+        return self.table["features"]
+
+    @property
+    def phashes(self):
+        return self.table["phash"]
+
+    def name(self, i):
+        return self.table["name"][i].decode("utf-8")
+
+    def names(self):
+        return [name.decode("utf-8") for name in self.table["name"]]
+
+    def fingerprint(self, i):
+        """Rebuild the JSON-style fingerprint dict of row i."""
+        row = self.table[i]
+        features = {key: float(value) for key, value in zip(FEATURE_KEYS, row["features"])
+                    if not np.isnan(value)}
+        return {"features": features, "phash": code_to_hex(row["phash"])}
+
+
+def load_index(fingerprint_dir):
+    """
+    Open the index of a fingerprint directory, building it from the JSON files
+    the first time if it does not exist yet (or was written in an older layout).
+    """
+    index_path = os.path.join(fingerprint_dir, INDEX_FILENAME)
+    if not os.path.exists(index_path) or not FingerprintIndex.is_current_layout(np.load(index_path, mmap_mode="r")):
+        FingerprintIndex.from_json_dir(fingerprint_dir).save(index_path)
+    return FingerprintIndex.open(index_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the fingerprint index from fingerprints/*.json")
+    parser.add_argument("directory", nargs="?",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fingerprints"))
+    args = parser.parse_args()
+
+    index = FingerprintIndex.from_json_dir(args.directory)
+    index.save(os.path.join(args.directory, INDEX_FILENAME))
+    print(f"Indexed {len(index)} fingerprints into {index.path}")
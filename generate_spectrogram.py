@@ -1,105 +1,435 @@
 import os
+import hashlib
 import librosa
 import numpy as np
-import matplotlib.pyplot as plt
 import json
-import hashlib
-import os
+import time
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from features import FeatureEngine
+from fingerprint_index import FingerprintIndex, INDEX_FILENAME, features_to_vector
+from ivf_index import build_ivf_index
+from landmarks import (LandmarkIndex, LANDMARK_DIRNAME, LANDMARK_PARAMETERS, landmark_fingerprint,
+                       save_track_landmarks, load_track_landmarks, track_landmark_table,
+                       track_landmarks_from_table)
+from manifest import IngestManifest, MANIFEST_FILENAME, file_sha256
+from metrics import FEATURE_SECONDS
+from perceptual_code import code_to_hex, perceptual_code
+from spectrogram_cache import SpectrogramCache, DEFAULT_MAX_BYTES, cache_key
+from tracing import span
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Bump whenever the content of fingerprints changes so that the manifest reprocesses every file.
+FINGERPRINT_VERSION = 3
+# Bump whenever spectrogram_from_audio changes so that cached spectrograms are not reused.
+SPECTROGRAM_VERSION = 1
+
+# Analysis window: only the first 30 seconds of every file are decoded and fingerprinted.
+DEFAULT_OFFSET = 0.0
+DEFAULT_DURATION = 30.0
+
+# Digest of the catalog the indexes were last built from (see catalog_state).
+INDEX_STATE_FILENAME = "index.state"
+
 class SpectrogramGenerator:
-    def __init__(self, data_path):
+    def __init__(self, data_path, offset=DEFAULT_OFFSET, duration=DEFAULT_DURATION,
+                 cache_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param offset: Start of the analysis window, in seconds.
+        :param duration: Length of the analysis window in seconds, None for the whole file.
+        :param cache_bytes: Disk budget of the spectrogram and landmark cache.
+        """
         self.data_path = data_path
+        self.offset = offset
+        self.duration = duration
+        self.feature_engine = FeatureEngine()
 
         self.output_path = os.path.join(BASE_DIR, "fingerprints")
+        self.index_path = os.path.join(self.output_path, INDEX_FILENAME)
+        self.landmark_path = os.path.join(self.output_path, LANDMARK_DIRNAME)
 
         self.spectrogram_path = os.path.join(BASE_DIR, "spectrograms")
+        self.cache = SpectrogramCache(os.path.join(BASE_DIR, "cache"), cache_bytes)
         if not os.path.exists(self.output_path):
             os.makedirs(self.output_path)
         if not os.path.exists(self.spectrogram_path):
             os.makedirs(self.spectrogram_path)
 
-    def generate_spectrogram(self, audio_path):
-        y, sr= librosa.load(audio_path, sr=None)
-        S = librosa.feature.melspectrogram(y=y, sr=sr)
-        S_DB = librosa.power_to_db(S, ref=np.max)
-        return S_DB
-
-    def extract_features(self, spectrogram):
+    def load_audio(self, audio_path):
         """
-        Extract summarized audio features from a spectrogram.
-        :param spectrogram: Spectrogram (assumed in dB scale).
-        :return: A dictionary containing summarized features.
+        Decode the analysis window of a file at its native rate.
+        The window is passed down to the decoder, which seeks to the offset and stops
+        after the duration, so long files cost no more than the window itself.
         """
-        features = {}
-        try:
-
-            amplitude_spectrogram = librosa.db_to_amplitude(spectrogram)
+        with span("librosa.load"):
+            return librosa.load(audio_path, sr=None, offset=self.offset, duration=self.duration)
 
+    @property
+    def fingerprint_version(self):
+        """Version recorded in the manifest: fingerprints also depend on the analysis window."""
+        return f"{FINGERPRINT_VERSION}:{self.offset}:{self.duration}"
 
-            features['spectral_centroid_mean'] = float(np.mean(librosa.feature.spectral_centroid(S=amplitude_spectrogram)))
-            features['spectral_bandwidth_mean'] = float(np.mean(librosa.feature.spectral_bandwidth(S=amplitude_spectrogram)))
-            features['spectral_contrast_mean'] = float(np.mean(librosa.feature.spectral_contrast(S=amplitude_spectrogram)))
-            features['spectral_rolloff_mean'] = float(np.mean(librosa.feature.spectral_rolloff(S=amplitude_spectrogram)))
+    def generate_spectrogram(self, audio_path):
+        y, sr = self.load_audio(audio_path)
+        return self.spectrogram_from_audio(y, sr)
 
+    def spectrogram_from_audio(self, y, sr):
+        with span("melspectrogram", samples=len(y), sr=sr):
+            S = librosa.feature.melspectrogram(y=y, sr=sr)
+        return self.spectrogram_from_power(S)
 
-            chroma = librosa.feature.chroma_stft(S=amplitude_spectrogram)
-            tonnetz = librosa.feature.tonnetz(chroma=chroma)
-            features['tonnetz_mean'] = float(np.mean(tonnetz))
+    def spectrogram_from_power(self, S):
+        """dB scale of a mel power spectrogram, relative to its maximum."""
+        with span("power_to_db"):
+            S_DB = librosa.power_to_db(S, ref=np.max)
+        return S_DB
 
+    def spectrogram_key(self, sha256):
+        return cache_key(sha256, "mel", SPECTROGRAM_VERSION, self.offset, self.duration)
 
-            zero_crossings = librosa.feature.zero_crossing_rate(amplitude_spectrogram)
-            features['zero_crossing_rate_mean'] = float(np.mean(zero_crossings))
+    def landmark_key(self, sha256):
+        return cache_key(sha256, "landmarks", LANDMARK_PARAMETERS, self.offset, self.duration)
 
+    def cached_analysis(self, file_path, sha256):
+        """
+        dB spectrogram and landmark fingerprint of a file, read from the cache when
+        possible: the file is only decoded if one of them is missing.
+        :param sha256: Content hash of the file.
+        """
+        S_DB = self.cache.get(self.spectrogram_key(sha256))
+        landmark_table = self.cache.get(self.landmark_key(sha256))
+        if S_DB is None or landmark_table is None:
+            y, sr = self.load_audio(file_path)
+            if S_DB is None:
+                S_DB = self.spectrogram_from_audio(y, sr)
+                self.cache.put(self.spectrogram_key(sha256), S_DB.astype(np.float32, copy=False))
+            if landmark_table is None:
+                landmark_table = track_landmark_table(self.landmark_fingerprint(y, sr))
+                self.cache.put(self.landmark_key(sha256), landmark_table)
+        return S_DB, track_landmarks_from_table(landmark_table)
 
-            mfcc = librosa.feature.mfcc(S=spectrogram, n_mfcc=13)
-            for i in range(mfcc.shape[0]):
-                features[f'mfcc_{i}_mean'] = float(np.mean(mfcc[i, :]))
+    def cached_spectrogram(self, file_path, sha256):
+        """Path of the cached dB spectrogram of a file, computing it first if needed."""
+        key = self.spectrogram_key(sha256)
+        if self.cache.get(key) is None:
+            S_DB = self.generate_spectrogram(file_path)
+            self.cache.put(key, S_DB.astype(np.float32, copy=False))
+        return self.cache.path(key)
 
+    def extract_features(self, spectrogram):
+        """
+        Extract summarized audio features from a spectrogram.
+        :param spectrogram: Spectrogram (assumed in dB scale).
+        :return: A dictionary containing summarized features.
+        """
+        features = {}
+        try:
+            with span("extract_features", frames=spectrogram.shape[-1]):
+                self.feature_engine.extract(spectrogram, features)
         except Exception as e:
             print(f"Error extracting features: {e}")
+        for name, seconds in self.feature_engine.timings.items():
+            FEATURE_SECONDS.observe(seconds, feature=name)
 
         return features
 
 
     def perceptual_hash(self, features):
-        features_str = json.dumps(features, sort_keys=True)
-        hash_object = hashlib.sha256(features_str.encode('utf-8'))
+        """
+        Fingerprint of a feature dict: the features and their binary perceptual code
+        (SimHash, hex), close for similar features.
+        """
+        with span("perceptual_hash"):
+            code = perceptual_code(features_to_vector(features, np.float64))
         return {
             "features": features,
-            "phash": hash_object.hexdigest()
+            "phash": code_to_hex(code)
         }
 
+    def landmark_fingerprint(self, y, sr):
+        """
+        Constellation fingerprint: hashes of spectral peak pairs and their anchor frames.
+        """
+        return landmark_fingerprint(y, sr)
+
     def save_fingerprint(self, fingerprint, filename):
         with open(filename, 'w') as file:
             json.dump(fingerprint, file, indent=4)
 
-    def process_files(self):
+    def find_audio_files(self):
+        """Yield (file name, path) of every audio file of the team folders."""
         for team in range(1, 21):
             if team == 2 or team == 4 or team == 12:
                 continue
             team_folder = os.path.join(self.data_path, f'Team_{team}')
             for file in os.listdir(team_folder):
                 if file.endswith('.wav') or file.endswith('.mp3'):
-                    file_path = os.path.join(team_folder, file)
-                    S_DB = self.generate_spectrogram(file_path)
+                    yield file, os.path.join(team_folder, file)
+
+    def analyze_file(self, file, file_path, images="deferred", sha256=None):
+        """
+        Compute everything stored for one audio file, from the cache when it is there.
+        :param images: "inline" renders the spectrogram PNG right away, otherwise it is
+                       rendered later from the cached dB spectrogram.
+        :return: (fingerprint, landmark fingerprint)
+        """
+        S_DB, landmarks = self.cached_analysis(file_path, sha256 or file_sha256(file_path))
+
+        if images == "inline":
+            render_spectrogram_image(S_DB, file, os.path.join(self.spectrogram_path, f"{file}.png"))
+
+        features = self.extract_features(S_DB)
+        return self.perceptual_hash(features), landmarks
+
+    def render_images(self, workers=1):
+        """
+        Render the PNG of every fingerprinted file that does not have one yet, from its
+        cached dB spectrogram (recomputed if it was evicted).
+        """
+        manifest = IngestManifest(os.path.join(self.output_path, MANIFEST_FILENAME))
+        jobs = [(self, os.path.join(self.data_path, key), entry["sha256"], entry["name"],
+                 os.path.join(self.spectrogram_path, f"{entry['name']}.png"))
+                for key, entry in sorted(manifest.entries.items())
+                if not os.path.exists(os.path.join(self.spectrogram_path, f"{entry['name']}.png"))]
+        if workers == 1:
+            for job in jobs:
+                _render_cached_image(*job)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for future in as_completed([pool.submit(_render_cached_image, *job) for job in jobs]):
+                    future.result()
+        print(f"Rendered {len(jobs)} spectrogram images")
+        self.evict_cache()
+
+    def evict_cache(self):
+        freed = self.cache.evict()
+        if freed:
+            print(f"Evicted {freed / 1024 ** 2:.1f} MB of cached spectrograms")
+
+    def process_files(self, workers=None, images="deferred", render_workers=1):
+        """
+        Fingerprint the new or changed audio files of the team folders.
+
+        A manifest records every fingerprinted file, so unchanged files are skipped, files
+        that disappeared are dropped, and an interrupted run resumes where it stopped.
+        File discovery feeds a bounded number of in-flight jobs to a pool of `workers`
+        processes (all cores by default, in-process when 1) that decode and extract
+        features, while this process is the single writer of fingerprints and indexes.
+
+        Decoded results (dB spectrograms and landmarks) are cached by file content, so
+        re-running after a feature change only re-extracts features from the cache.
+
+        :param images: "deferred" queues spectrogram PNGs to a separate pool of
+                       `render_workers` processes, "none" only caches the dB spectrograms
+                       (see render_images), "inline" renders them in the ingestion workers.
+        """
+        workers = workers or os.cpu_count() or 1
+        manifest = IngestManifest(os.path.join(self.output_path, MANIFEST_FILENAME))
+        tracks_path = os.path.join(self.landmark_path, "tracks")
+        os.makedirs(tracks_path, exist_ok=True)
+
+        seen = set()
+        skipped = 0
+
+        def jobs():
+            nonlocal skipped
+            for file, file_path in self.find_audio_files():
+                key = os.path.relpath(file_path, self.data_path)
+                seen.add(key)
+                stat = os.stat(file_path)
+                if manifest.is_current(key, file_path, stat, self.fingerprint_version):
+                    skipped += 1
+                    continue
+                yield self, key, file, file_path, stat, images
+
+        processed = 0
+        renders = []
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            if images == "deferred":
+                render_pool = stack.enter_context(ProcessPoolExecutor(max_workers=render_workers))
+            if workers == 1:
+                results = (_analyze_file(*job) for job in jobs())
+            else:
+                pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+                results = bounded_map(pool, _analyze_file, jobs(), max_pending=2 * workers)
+
+            for key, file, stat, sha256, result in results:
+                if isinstance(result, Exception):
+                    print(f"Error processing {file}: {result}")
+                    continue
+                fingerprint, landmark_fingerprint = result
+                self.save_fingerprint(fingerprint, os.path.join(self.output_path, f"{file}.json"))
+                save_track_landmarks(os.path.join(tracks_path, f"{file}.npy"), landmark_fingerprint)
+                # The manifest record is the commit point of this file.
+                manifest.commit(key, file, stat, sha256, self.fingerprint_version)
+                processed += 1
+
+                if images == "deferred":
+                    renders.append(render_pool.submit(
+                        _render_image, self.cache.path(self.spectrogram_key(sha256)), file,
+                        os.path.join(self.spectrogram_path, f"{file}.png")))
+
+                elapsed = time.perf_counter() - start
+                print(f"Processed {file} ({processed} files, {processed / elapsed:.1f} files/s)")
+            ingest_elapsed = time.perf_counter() - start
+
+            for future in as_completed(renders):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error rendering spectrogram image: {e}")
+
+        removed = [key for key in manifest.entries if key not in seen]
+        for key in removed:
+            file = manifest.entries[key]["name"]
+            for path in (os.path.join(self.output_path, f"{file}.json"),
+                         os.path.join(tracks_path, f"{file}.npy"),
+                         os.path.join(self.spectrogram_path, f"{file}.png")):
+                if os.path.exists(path):
+                    os.remove(path)
+            manifest.remove(key)
+            print(f"Removed {file}")
+        manifest.compact()
+        self.evict_cache()
+
+        # Also catches a run interrupted between its last commit and the rebuild.
+        if processed or removed or not self.indexes_current(manifest):
+            self.build_indexes(manifest)
+
+        print(f"Ingested {processed} files in {ingest_elapsed:.1f}s "
+              f"({processed / max(ingest_elapsed, 1e-9):.1f} files/s, {workers} workers), "
+              f"{skipped} unchanged, {len(removed)} removed")
+        if renders:
+            print(f"Rendered {len(renders)} spectrogram images in {time.perf_counter() - start:.1f}s total")
+
+    def catalog_state(self, manifest):
+        """
+        Digest of what the indexes are built from: every fingerprint JSON of the folder
+        (including ones that were not ingested through the manifest) and the manifest records.
+        """
+        names = sorted(file for file in os.listdir(self.output_path) if file.endswith(".json"))
+        records = sorted((entry["name"], entry["sha256"], entry["fingerprint_version"])
+                         for entry in manifest.entries.values())
+        return hashlib.sha256(json.dumps([names, records]).encode()).hexdigest()
+
+    def indexes_current(self, manifest):
+        """Whether the indexes on disk were built from the current catalog."""
+        try:
+            with open(os.path.join(self.output_path, INDEX_STATE_FILENAME), "r") as f:
+                state = f.read().strip()
+        except FileNotFoundError:
+            return False
+        return os.path.exists(self.index_path) and state == self.catalog_state(manifest)
+
+    def build_indexes(self, manifest):
+        """
+        Rebuild the feature and landmark indexes from the stored per-file fingerprints.
+        The feature index covers every fingerprint JSON of the folder, like load_index,
+        and the landmark index the tracks whose landmarks were stored by ingestion.
+        """
+        tracks_path = os.path.join(self.landmark_path, "tracks")
+        state = self.catalog_state(manifest)
+
+        index = FingerprintIndex.from_json_dir(self.output_path)
+        index.save(self.index_path)
+        print(f"Indexed {len(index)} fingerprints into {self.index_path}")
+        ivf = build_ivf_index(self.output_path, index)
+        if ivf is not None:
+            print(f"Clustered them into {ivf.n_lists} IVF lists")
+        names = [name for name in index.names() if os.path.exists(os.path.join(tracks_path, f"{name}.npy"))]
+        LandmarkIndex.from_fingerprints(
+            (name, load_track_landmarks(os.path.join(tracks_path, f"{name}.npy"))) for name in names
+        ).save(self.landmark_path)
+        if len(names) < len(index):
+            print(f"{len(index) - len(names)} fingerprints have no landmarks (re-ingest their audio to add them)")
+
+        # Written last: an interrupted rebuild leaves the previous state, so it is redone.
+        tmp_path = os.path.join(self.output_path, f"{INDEX_STATE_FILENAME}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(state + "\n")
+        os.replace(tmp_path, os.path.join(self.output_path, INDEX_STATE_FILENAME))
+
+
+def render_spectrogram_image(S_DB, title, filename):
+    """
+    Render a dB mel spectrogram to a PNG file.
+    Uses a bare Agg figure rather than pyplot, so it is safe in headless worker processes.
+    """
+    from matplotlib.figure import Figure
+    import librosa.display
+
+    fig = Figure(figsize=(10, 4))
+    ax = fig.subplots()
+    image = librosa.display.specshow(S_DB, sr=22050, x_axis='time', y_axis='mel', ax=ax)
+    fig.colorbar(image, ax=ax, format='%+2.0f dB')
+    ax.set_title(title)
+    fig.tight_layout()
+    fig.savefig(filename)
+
+
+def _render_image(spectrogram_file, title, filename):
+    render_spectrogram_image(np.load(spectrogram_file, mmap_mode="r"), title, filename)
+
+
+def _render_cached_image(generator, file_path, sha256, title, filename):
+    _render_image(generator.cached_spectrogram(file_path, sha256), title, filename)
+
+
+def _analyze_file(generator, key, file, file_path, stat, images):
+    """Worker entry point: errors are returned so that one bad file does not stop the run."""
+    try:
+        sha256 = file_sha256(file_path)
+        return key, file, stat, sha256, generator.analyze_file(file, file_path, images, sha256)
+    except Exception as e:
+        return key, file, stat, None, e
+
 
+def bounded_map(pool, fn, args_iterable, max_pending):
+    """
+    Submit fn(*args) to the pool while keeping at most max_pending jobs in flight,
+    yielding results as they complete.
+    """
+    pending = set()
+    for args in args_iterable:
+        pending.add(pool.submit(fn, *args))
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in as_completed(pending):
+        yield future.result()
 
-                    plt.figure(figsize=(10, 4))
-                    librosa.display.specshow(S_DB, sr=22050, x_axis='time', y_axis='mel')
-                    plt.colorbar(format='%+2.0f dB')
-                    plt.title(file)
-                    plt.tight_layout()
-                    spectrogram_filename = os.path.join(self.spectrogram_path, f"{file}.png")
-                    plt.savefig(spectrogram_filename)
-                    plt.close()
 
-                    features = self.extract_features(S_DB)
-                    fingerprint = self.perceptual_hash(features)
-                    fingerprint_filename = os.path.join(self.output_path, f"{file}.json")
-                    self.save_fingerprint(fingerprint, fingerprint_filename)
-                    print(f"Processed {file}")
+if __name__ == "__main__":
+    import argparse
 
+    parser = argparse.ArgumentParser(description="Fingerprint the audio files of the Team_N folders")
+    parser.add_argument("data_path", nargs="?", default=os.path.join(BASE_DIR, "Task_5_Data"))
+    parser.add_argument("--offset", type=float, default=DEFAULT_OFFSET,
+                        help="Start of the analysis window in seconds")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION,
+                        help="Length of the analysis window in seconds (0 for whole files)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes (default: all cores, 1 to run in-process)")
+    parser.add_argument("--images", choices=["deferred", "inline", "none"], default="deferred",
+                        help="When to render spectrogram PNGs (default: in a separate render pool)")
+    parser.add_argument("--no-images", dest="images", action="store_const", const="none",
+                        help="Skip PNG rendering, only store the dB spectrograms")
+    parser.add_argument("--render-workers", type=int, default=1,
+                        help="Number of processes rendering PNGs in deferred mode")
+    parser.add_argument("--render-only", action="store_true",
+                        help="Only render the missing PNGs of fingerprinted files")
+    parser.add_argument("--cache-mb", type=int, default=DEFAULT_MAX_BYTES // 1024 ** 2,
+                        help="Disk budget of the spectrogram cache in MB")
+    args = parser.parse_args()
 
+    generator = SpectrogramGenerator(args.data_path, offset=args.offset, duration=args.duration or None,
+                                     cache_bytes=args.cache_mb * 1024 ** 2)
+    if args.render_only:
+        generator.render_images(workers=args.render_workers)
+    else:
+        generator.process_files(workers=args.workers, images=args.images,
+                                render_workers=args.render_workers)
@@ -0,0 +1,220 @@
+import os
+
+import numpy as np
+
+from similarity import WEIGHT_VECTOR
+
+
+IVF_FILENAME = "ivf.npz"
+# Bump whenever transform() changes: indexes of another version are ignored and rebuilt.
+IVF_VERSION = 2
+# Exhaustive scans by default: probing trades recall for latency, measure it first
+# (python ivf_index.py, or benchmark.py --ivf) and pass --nprobe where it pays off.
+DEFAULT_NPROBE = None
+# Relative differences are measured down to this fraction of a feature's spread.
+LOG_FLOOR = 0.1
+# Below this size an exhaustive scan is as fast as probing, so no IVF index is built.
+IVF_MIN_TRACKS = 5000
+KMEANS_ITERATIONS = 25
+
+
+def _squared_distances(points, centroids):
+    """(len(points), len(centroids)) squared euclidean distances."""
+    return (np.einsum("ij,ij->i", points, points)[:, None]
+            - 2 * points @ centroids.T
+            + np.einsum("ij,ij->i", centroids, centroids)[None, :])
+
+
+def kmeans(points, n_clusters, iterations=KMEANS_ITERATIONS, seed=0, chunk_size=65536):
+    """
+    Lloyd's k-means with k-means++ seeding.
+    :return: (centroids, cluster of every point)
+    """
+    rng = np.random.default_rng(seed)
+    n = len(points)
+
+    # k-means++ on a sample: enough for a good start without N * k seeding passes.
+    sample = points[rng.choice(n, size=min(n, 50 * n_clusters), replace=False)]
+    centroids = [sample[rng.integers(len(sample))]]
+    closest = np.sum((sample - centroids[0]) ** 2, axis=1)
+    for _ in range(1, n_clusters):
+        probabilities = closest / closest.sum() if closest.sum() > 0 else None
+        centroids.append(sample[rng.choice(len(sample), p=probabilities)])
+        closest = np.minimum(closest, np.sum((sample - centroids[-1]) ** 2, axis=1))
+    centroids = np.array(centroids)
+
+    assignment = np.zeros(n, dtype=np.int64)
+    for _ in range(iterations):
+        distances = np.empty(n)
+        for start in range(0, n, chunk_size):
+            chunk = _squared_distances(points[start:start + chunk_size], centroids)
+            assignment[start:start + chunk_size] = np.argmin(chunk, axis=1)
+            distances[start:start + chunk_size] = chunk[np.arange(len(chunk)), assignment[start:start + chunk_size]]
+
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, points)
+        updated = sums / np.maximum(counts, 1)[:, None]
+
+        # Empty clusters restart on the points furthest from their centroid.
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            updated[empty] = points[np.argsort(-distances)[:len(empty)]]
+
+        if np.allclose(updated, centroids):
+            break
+        centroids = updated
+
+    return centroids, assignment
+
+
+class IVFIndex:
+    """
+    Inverted-file index over the feature vectors of a FingerprintIndex.
+
+    The similarity compares features by relative difference, 1 - |a-b| / (|a|+|b|),
+    which for same-sign values is tanh(|log a - log b| / 2). Feature vectors are thus
+    clustered in a signed log space, sign(x) * log(1 + |x| * scale), weighted by the
+    similarity weights (missing features at the mean). Each cluster lists its catalog
+    rows, stored contiguously in `rows` between `offsets`. A query only visits the rows
+    of its `nprobe` nearest clusters, which are then scored with the exact similarity
+    formula, so recall and latency both grow with nprobe.
+    """
+
+    def __init__(self, centroids, mean, scale, offsets, rows, path=None, version=IVF_VERSION):
+        self.centroids = centroids
+        self.mean = mean
+        self.scale = scale
+        self.offsets = offsets
+        self.rows = rows
+        self.path = path
+        self.version = version
+
+    @classmethod
+    def build(cls, features, n_lists=None, seed=0):
+        """
+        :param features: (N, len(FEATURE_KEYS)) catalog matrix, NaN for missing features.
+        :param n_lists: Number of clusters, about sqrt(N) by default.
+        """
+        features = np.asarray(features, dtype=np.float64)
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(features)))), len(features))
+
+        mean = np.nan_to_num(np.nanmean(features, axis=0))
+        std = np.nan_to_num(np.nanstd(features, axis=0))
+        scale = 1 / (LOG_FLOOR * np.where(std > 0, std, 1))
+        index = cls(None, mean, scale, None, None)
+
+        centroids, assignment = kmeans(index.transform(features), n_lists, seed=seed)
+        index.centroids = centroids
+        index.rows = np.argsort(assignment, kind="stable")
+        index.offsets = np.r_[0, np.cumsum(np.bincount(assignment, minlength=n_lists))]
+        return index
+
+    @classmethod
+    def open(cls, path):
+        with np.load(path) as data:
+            version = int(data["version"]) if "version" in data else 1
+            return cls(data["centroids"], data["mean"], data["scale"], data["offsets"], data["rows"], path,
+                       version)
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, centroids=self.centroids, mean=self.mean, scale=self.scale,
+                     offsets=self.offsets, rows=self.rows, version=self.version)
+        os.replace(tmp_path, path)
+        self.path = path
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def transform(self, features):
+        features = np.asarray(features, dtype=np.float64)
+        features = np.where(np.isnan(features), self.mean, features)
+        return np.sign(features) * np.log1p(np.abs(features) * self.scale) * WEIGHT_VECTOR
+
+    def candidates(self, query_vector, nprobe):
+        """Catalog rows of the nprobe clusters nearest to the query."""
+        query = self.transform(np.asarray(query_vector)[None, :])
+        distances = _squared_distances(query, self.centroids)[0]
+        if nprobe >= self.n_lists:
+            return self.rows
+        probed = np.argpartition(distances, nprobe)[:nprobe]
+        return np.concatenate([self.rows[self.offsets[c]:self.offsets[c + 1]] for c in probed])
+
+
+def build_ivf_index(fingerprint_dir, index, n_lists=None):
+    """
+    (Re)build the IVF index of a fingerprint directory's FingerprintIndex.
+    Small catalogs get none, and a stale one is removed.
+    """
+    path = os.path.join(fingerprint_dir, IVF_FILENAME)
+    if len(index) < IVF_MIN_TRACKS and n_lists is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+    ivf = IVFIndex.build(index.features, n_lists)
+    ivf.save(path)
+    return ivf
+
+
+def load_ivf_index(fingerprint_dir, catalog_size):
+    """
+    Open the IVF index of a fingerprint directory, or None if absent, built for another
+    catalog or by another version (until build_indexes rebuilds it).
+    """
+    path = os.path.join(fingerprint_dir, IVF_FILENAME)
+    if not os.path.exists(path):
+        return None
+    ivf = IVFIndex.open(path)
+    return ivf if len(ivf) == catalog_size and ivf.version == IVF_VERSION else None
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from fingerprint_index import load_index
+    from similarity import CatalogScorer
+
+    parser = argparse.ArgumentParser(description="Build the IVF index and measure its recall and latency")
+    parser.add_argument("directory", nargs="?",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fingerprints"))
+    parser.add_argument("--lists", type=int, default=None, help="Number of clusters (default: sqrt(N))")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--queries", type=int, default=200, help="Catalog entries used as queries")
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    index = load_index(args.directory)
+    start = time.perf_counter()
+    ivf = IVFIndex.build(index.features, args.lists)
+    ivf.save(os.path.join(args.directory, IVF_FILENAME))
+    print(f"Clustered {len(ivf)} fingerprints into {ivf.n_lists} lists in {time.perf_counter() - start:.1f}s")
+
+    scorer = CatalogScorer(index.features, index.phashes)
+    rng = np.random.default_rng(0)
+    queries = rng.choice(len(index), size=min(args.queries, len(index)), replace=False)
+    features, phashes = np.asarray(index.features, dtype=np.float64), index.phashes
+
+    def top(scores, rows, k):
+        return set(rows[np.argsort(-scores, kind="stable")[:k]].tolist())
+
+    start = time.perf_counter()
+    exact = [top(scorer.score(features[q], phashes[q]), np.arange(len(index)), args.top_k)
+             for q in queries]
+    print(f"exhaustive: {(time.perf_counter() - start) / len(queries) * 1000:.2f} ms/query")
+
+    for nprobe in args.nprobe:
+        start = time.perf_counter()
+        recall = 0
+        for q, truth in zip(queries, exact):
+            rows = ivf.candidates(features[q], nprobe)
+            recall += len(top(scorer.score(features[q], phashes[q], rows), rows, args.top_k) & truth)
+        elapsed = (time.perf_counter() - start) / len(queries)
+        print(f"nprobe={nprobe}: recall@{args.top_k}={recall / (len(queries) * args.top_k):.3f}, "
+              f"{elapsed * 1000:.2f} ms/query")
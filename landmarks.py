@@ -0,0 +1,262 @@
+import json
+import os
+from collections import namedtuple
+
+import librosa
+import numpy as np
+from scipy.ndimage import maximum_filter
+
+from similarity import top_k_indices
+
+
+LANDMARK_DIRNAME = "landmarks"
+LANDMARK_INDEX_FILENAME = "index.npy"
+LANDMARK_NAMES_FILENAME = "names.json"
+
+# Landmarks are computed at a fixed rate so that frame and bin indices mean the same
+# thing for every file, whatever its native sample rate.
+SAMPLE_RATE = 11025
+N_FFT = 1024
+HOP_LENGTH = 256
+
+PEAK_NEIGHBORHOOD = (20, 20)  # (frequency bins, frames)
+PEAK_MIN_DB = -50.0
+FAN_OUT = 10
+MAX_DELTA_T = 63
+
+FREQ_BITS = 10
+DELTA_T_BITS = 8
+
+# Everything a landmark fingerprint depends on, for caches keyed by analysis settings.
+LANDMARK_PARAMETERS = (SAMPLE_RATE, N_FFT, HOP_LENGTH, PEAK_NEIGHBORHOOD, PEAK_MIN_DB,
+                       FAN_OUT, MAX_DELTA_T, FREQ_BITS, DELTA_T_BITS)
+
+LANDMARK_DTYPE = np.dtype([("hash", "<u4"), ("track", "<u4"), ("time", "<u4")])
+TRACK_LANDMARK_DTYPE = np.dtype([("hash", "<u4"), ("time", "<u4")])
+
+LandmarkMatch = namedtuple("LandmarkMatch", ["name", "similarity", "matches", "offset"])
+
+
+def frames_to_seconds(frames):
+    return frames * HOP_LENGTH / SAMPLE_RATE
+
+
+def find_peaks(y, sr):
+    """
+    Pick the constellation of spectral peaks of a signal.
+    :return: (frequency bins, frames) of the peaks, sorted by time then frequency.
+    """
+    if sr != SAMPLE_RATE:
+        y = librosa.resample(y, orig_sr=sr, target_sr=SAMPLE_RATE)
+    S = np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH))
+    S_DB = librosa.amplitude_to_db(S, ref=np.max)
+
+    local_max = maximum_filter(S_DB, size=PEAK_NEIGHBORHOOD, mode="constant", cval=-np.inf)
+    freqs, frames = np.nonzero((S_DB == local_max) & (S_DB > PEAK_MIN_DB))
+    order = np.lexsort((freqs, frames))
+    return freqs[order], frames[order]
+
+
+def hash_peaks(freqs, frames):
+    """
+    Pair every anchor peak with the next FAN_OUT peaks and hash each pair as (f1, f2, dt).
+    :return: (hashes, anchor frames) as uint32 arrays.
+    """
+    hashes, times = [], []
+    for k in range(1, FAN_OUT + 1):
+        f1, f2 = freqs[:-k], freqs[k:]
+        t1, t2 = frames[:-k], frames[k:]
+        dt = t2 - t1
+        valid = (dt > 0) & (dt <= MAX_DELTA_T)
+        hashes.append((f1[valid].astype(np.uint32) << (FREQ_BITS + DELTA_T_BITS))
+                      | (f2[valid].astype(np.uint32) << DELTA_T_BITS)
+                      | dt[valid].astype(np.uint32))
+        times.append(t1[valid].astype(np.uint32))
+
+    if not hashes:
+        return np.empty(0, np.uint32), np.empty(0, np.uint32)
+    return np.concatenate(hashes), np.concatenate(times)
+
+
+def landmark_fingerprint(y, sr):
+    hashes, times = hash_peaks(*find_peaks(y, sr))
+    return {"hashes": hashes, "times": times}
+
+
+def track_landmark_table(fingerprint):
+    table = np.empty(len(fingerprint["hashes"]), dtype=TRACK_LANDMARK_DTYPE)
+    table["hash"] = fingerprint["hashes"]
+    table["time"] = fingerprint["times"]
+    return table
+
+
+def track_landmarks_from_table(table):
+    return {"hashes": table["hash"], "times": table["time"]}
+
+
+def save_track_landmarks(path, fingerprint):
+    """Store the landmarks of one track so that the index can be rebuilt without decoding it again."""
+    np.save(path, track_landmark_table(fingerprint))
+
+
+def load_track_landmarks(path):
+    return track_landmarks_from_table(np.load(path))
+
+
+class LandmarkIndex:
+    """
+    Inverted index from landmark hash to (track id, anchor time).
+
+    Entries are stored in a single .npy file sorted by hash, so a lookup is a binary
+    search per query hash and its cost depends on the number of hits, not on the
+    catalog size. Track names are kept in a JSON file next to it, both in a
+    landmarks/ directory of the fingerprint folder.
+    """
+
+    def __init__(self, table, names, path=None):
+        self.table = table
+        self.names = names
+        self.path = path
+
+    @classmethod
+    def from_fingerprints(cls, items):
+        """
+        :param items: Iterable of (track name, landmark fingerprint dict) pairs.
+        """
+        names, parts = [], []
+        for track_id, (name, fingerprint) in enumerate(items):
+            part = np.empty(len(fingerprint["hashes"]), dtype=LANDMARK_DTYPE)
+            part["hash"] = fingerprint["hashes"]
+            part["track"] = track_id
+            part["time"] = fingerprint["times"]
+            names.append(name)
+            parts.append(part)
+
+        table = np.concatenate(parts) if parts else np.empty(0, dtype=LANDMARK_DTYPE)
+        table = table[np.argsort(table["hash"], kind="stable")]
+        return cls(table, names)
+
+    @classmethod
+    def open(cls, directory):
+        with open(os.path.join(directory, LANDMARK_NAMES_FILENAME), "r") as f:
+            names = json.load(f)
+        path = os.path.join(directory, LANDMARK_INDEX_FILENAME)
+        return cls(np.load(path, mmap_mode="r"), names, path)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, LANDMARK_INDEX_FILENAME)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, self.table)
+        os.replace(tmp_path, path)
+        with open(os.path.join(directory, LANDMARK_NAMES_FILENAME), "w") as f:
+            json.dump(self.names, f, indent=4)
+        self.path = path
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, hashes, times):
+        """
+        Find every catalog occurrence of the query hashes.
+        :return: (track ids, catalog anchor times, query anchor times) of the hits.
+        """
+        hashes = np.asarray(hashes, dtype=np.uint32)
+        catalog_hashes = self.table["hash"]
+        left = np.searchsorted(catalog_hashes, hashes, side="left")
+        right = np.searchsorted(catalog_hashes, hashes, side="right")
+        counts = right - left
+
+        # Expand every [left, right) range into row positions without a Python loop.
+        total = int(counts.sum())
+        starts = np.repeat(left - (np.cumsum(counts) - counts), counts)
+        rows = self.table[np.arange(total) + starts]
+        query_times = np.repeat(np.asarray(times, dtype=np.uint32), counts)
+        return rows["track"], rows["time"], query_times
+
+    def score(self, fingerprint, scorer=None):
+        """
+        Score every track for a landmark fingerprint.
+        :param scorer: Hit scorer, OffsetHistogramScorer by default.
+        :return: (similarity percentages, supporting hashes, offsets in frames) per track.
+        """
+        scorer = scorer or OffsetHistogramScorer()
+        track_ids, db_times, query_times = self.lookup(fingerprint["hashes"], fingerprint["times"])
+        matches, offsets = scorer.score(track_ids, db_times, query_times, len(self))
+        percentages = np.minimum(matches / max(len(fingerprint["hashes"]), 1) * 100, 100)
+        return percentages, matches, offsets
+
+    def match(self, i, percentages, matches, offsets):
+        return LandmarkMatch(self.names[i], float(percentages[i]), int(matches[i]),
+                             float(frames_to_seconds(offsets[i])))
+
+    def query(self, fingerprint, scorer=None, top_k=None):
+        """
+        Rank the catalog for a landmark fingerprint.
+        :return: LandmarkMatch list sorted by decreasing similarity (at most top_k), where
+                 similarity is the percentage of query hashes supporting the match and
+                 offset is the position of the query inside the track, in seconds.
+        """
+        scores = self.score(fingerprint, scorer)
+        return [self.match(i, *scores) for i in top_k_indices(scores[0], top_k)]
+
+
+class HitCountScorer:
+    """Count every hash hit of a track, wherever it falls in time."""
+
+    def score(self, track_ids, db_times, query_times, n_tracks):
+        """
+        :return: (score, offset in frames) arrays of length n_tracks.
+        """
+        return np.bincount(track_ids, minlength=n_tracks), np.zeros(n_tracks, dtype=np.int64)
+
+
+class OffsetHistogramScorer:
+    """
+    Vote on the time offset (catalog time - query time) of every hit.
+
+    A real match lines up many hits on the same offset, while random hash collisions
+    spread out, so the score of a track is the height of its histogram peak and the
+    peak position is where the query starts inside the track.
+    """
+
+    def score(self, track_ids, db_times, query_times, n_tracks):
+        scores = np.zeros(n_tracks, dtype=np.int64)
+        best_offsets = np.zeros(n_tracks, dtype=np.int64)
+        if len(track_ids) == 0:
+            return scores, best_offsets
+
+        offsets = db_times.astype(np.int64) - query_times.astype(np.int64)
+        min_offset = offsets.min()
+        span = int(offsets.max() - min_offset) + 1
+
+        # One histogram bin per (track, offset) pair.
+        keys = track_ids.astype(np.int64) * span + (offsets - min_offset)
+        bins, counts = np.unique(keys, return_counts=True)
+        tracks = bins // span
+
+        # Bins come out grouped by track: take each group's maximum, then its first bin
+        # reaching that maximum (the earliest offset on ties).
+        heads = np.flatnonzero(np.r_[True, tracks[1:] != tracks[:-1]])
+        peaks = np.maximum.reduceat(counts, heads)
+        at_peak = np.flatnonzero(counts == np.repeat(peaks, np.diff(np.r_[heads, len(counts)])))
+        first = at_peak[np.r_[True, tracks[at_peak][1:] != tracks[at_peak][:-1]]]
+
+        scores[tracks[heads]] = peaks
+        best_offsets[tracks[first]] = bins[first] % span + min_offset
+        return scores, best_offsets
+
+
+SCORERS = {
+    "hits": HitCountScorer,
+    "offset": OffsetHistogramScorer,
+}
+
+
+def load_landmark_index(fingerprint_dir):
+    """Open the landmark index of a fingerprint directory, or None if it was never built."""
+    directory = os.path.join(fingerprint_dir, LANDMARK_DIRNAME)
+    if not os.path.exists(os.path.join(directory, LANDMARK_INDEX_FILENAME)):
+        return None
+    return LandmarkIndex.open(directory)
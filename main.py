@@ -1,18 +1,26 @@
 import sys
 import os
-import json
-import numpy as np
-import librosa
-import soundfile as sf
+import threading
+import time
+
+# Origine des mesures de démarrage (première image, moteur prêt), prise avant les imports de Qt
+STARTED = time.perf_counter()
+
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QLabel, QPushButton, QSlider,
     QFileDialog, QMessageBox, QVBoxLayout, QHBoxLayout, QGridLayout,
-    QTableWidget, QTableWidgetItem, QFrame, QProgressBar, QGraphicsDropShadowEffect,
+    QTableView, QFrame, QProgressBar, QGraphicsDropShadowEffect,
     QSizePolicy, QHeaderView, QSpacerItem
 )
-from PyQt5.QtCore import Qt, QPropertyAnimation, QEasingCurve, QTimer, QSize, pyqtSignal
+from PyQt5.QtCore import (
+    Qt, QPropertyAnimation, QEasingCurve, QTimer, QSize, QThread, pyqtSignal,
+    QAbstractTableModel, QModelIndex
+)
 from PyQt5.QtGui import QPixmap, QFont, QColor, QPalette, QIcon, QFontDatabase
-from generate_spectrogram import SpectrogramGenerator
+# librosa, scipy et numpy ne sont importés qu'en arrière-plan (WarmUpWorker), après l'affichage
+from metrics import METRICS_ENV, REGISTRY, STAGE_SECONDS, timed
+import tracing
+from tracing import span
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -108,7 +116,7 @@ class ModernSlider(QSlider):
         """)
 
 
-class ModernTableWidget(QTableWidget):
+class ModernTableView(QTableView):
     """Tableau stylisé avec des lignes alternées et animations de survol"""
 
     def __init__(self, *args, **kwargs):
@@ -116,7 +124,7 @@ class ModernTableWidget(QTableWidget):
 
         
         self.setStyleSheet(f"""
-            QTableWidget {{
+            QTableView {{
                 background-color: {COLORS["card"]};
                 color: {COLORS["text_primary"]};
                 gridline-color: {COLORS["border"]};
@@ -125,15 +133,15 @@ class ModernTableWidget(QTableWidget):
                 padding: 5px;
                 font-size: 14px;
             }}
-            QTableWidget::item {{
+            QTableView::item {{
                 padding: 10px;
                 border-radius: 5px;
             }}
-            QTableWidget::item:selected {{
+            QTableView::item:selected {{
                 background-color: {COLORS["primary"]};
                 color: {COLORS["text_primary"]};
             }}
-            QTableWidget::item:hover {{
+            QTableView::item:hover {{
                 background-color: {COLORS["hover"]};
             }}
             QHeaderView::section {{
@@ -170,6 +178,85 @@ class ModernTableWidget(QTableWidget):
         self.setGraphicsEffect(shadow)
 
 
+def similarity_status(similarity):
+    if similarity >= 80:
+        return ("Élevée", COLORS["success"])
+    elif similarity >= 20:
+        return ("Moyenne", COLORS["warning"])
+    else:
+        return ("Faible", COLORS["error"])
+
+
+class ResultsTableModel(QAbstractTableModel):
+    """
+    Modèle des correspondances, chargé par lots au défilement.
+    Seules les lignes visibles sont construites, quelle que soit la taille du catalogue.
+    """
+
+    HEADERS = ["Titre de la chanson", "Pourcentage de similarité", "Statut"]
+    BATCH_SIZE = 100
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.results = []
+        self.loaded = 0
+
+    def set_results(self, results):
+        """:param results: Séquence triée de (nom, similarité), par exemple un RankedMatches"""
+        self.beginResetModel()
+        self.results = results
+        self.loaded = min(self.BATCH_SIZE, len(results))
+        self.endResetModel()
+
+    def clear(self):
+        self.set_results([])
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.loaded
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.loaded < len(self.results)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        count = min(self.BATCH_SIZE, len(self.results) - self.loaded)
+        self.beginInsertRows(QModelIndex(), self.loaded, self.loaded + count - 1)
+        self.loaded += count
+        self.endInsertRows()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+    @staticmethod
+    def song_name(filename):
+        song_name = filename.replace('.json', '')
+        return song_name[:-4] if song_name.endswith('_out') else song_name
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        filename, similarity = self.results[index.row()][:2]
+        column = index.column()
+
+        if role == Qt.DisplayRole:
+            if column == 0:
+                return self.song_name(filename)
+            if column == 1:
+                return f"{similarity:.2f}%"
+            return similarity_status(similarity)[0]
+        if role == Qt.TextAlignmentRole:
+            return int(Qt.AlignLeft | Qt.AlignVCenter) if column == 0 else int(Qt.AlignCenter)
+        if role == Qt.ForegroundRole and column == 2:
+            return QColor(similarity_status(similarity)[1])
+        return None
+
+
 class CircularProgressBar(QProgressBar):
     """Barre de progression circulaire pour indiquer le chargement"""
 
@@ -260,6 +347,175 @@ class LoadingOverlay(QWidget):
         self.label.setText(message)
 
 
+STAGE_MESSAGES = {
+    "decode": "Décodage du fichier...",
+    "features": "Extraction des caractéristiques...",
+    "landmarks": "Extraction des landmarks...",
+    "search": "Recherche dans le catalogue...",
+}
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class RecognitionWorker(QThread):
+    """Exécute une analyse hors du thread graphique pour que l'interface reste fluide"""
+
+    progress = pyqtSignal(str)
+    succeeded = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, fn, *args):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """L'annulation prend effet à la prochaine étape signalée par la tâche"""
+        self.cancelled = True
+
+    def report(self, message):
+        if self.cancelled:
+            raise TaskCancelled()
+        self.progress.emit(message)
+
+    def run(self):
+        try:
+            result = self.fn(self.report, *self.args)
+        except TaskCancelled:
+            return
+        except Exception as e:
+            if not self.cancelled:
+                self.failed.emit(str(e))
+            return
+        if not self.cancelled:
+            self.succeeded.emit(result)
+
+
+class MixPreviewWorker(QThread):
+    """
+    Aperçu du mixage pendant le déplacement du curseur : les deux chansons sont analysées
+    une seule fois (MixSession), puis chaque position demandée est reclassée. Seule la
+    dernière position en attente est calculée, les positions intermédiaires sont sautées.
+    """
+
+    ready = pyqtSignal(float, object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, make_session):
+        super().__init__()
+        self.make_session = make_session
+        self.condition = threading.Condition()
+        self.pending_ratio = None
+        self.stopped = False
+
+    def request(self, mix_ratio):
+        with self.condition:
+            self.pending_ratio = mix_ratio
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        try:
+            session = self.make_session()
+        except Exception as e:
+            if not self.stopped:
+                self.failed.emit(str(e))
+            return
+
+        while True:
+            with self.condition:
+                while self.pending_ratio is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                mix_ratio, self.pending_ratio = self.pending_ratio, None
+
+            try:
+                ranking = session.rank(mix_ratio)
+            except Exception as e:
+                if not self.stopped:
+                    self.failed.emit(str(e))
+                return
+            if not self.stopped:
+                self.ready.emit(mix_ratio, ranking)
+
+
+class WarmUpWorker(QThread):
+    """
+    Prépare le moteur de reconnaissance une fois la fenêtre affichée : imports lourds,
+    ouverture de l'index, puis une analyse factice qui paie les coûts du premier appel
+    (compilation numba, bancs de filtres, plans FFT) avant la première vraie requête.
+    """
+
+    ready = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, base_folder):
+        super().__init__()
+        self.base_folder = base_folder
+        # (reconnaisseur, message d'erreur) de la dernière préparation terminée
+        self.outcome = (None, None)
+        # Levé par le thread de préparation lui-même : l'attente ne dépend pas de la boucle Qt
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def failed_before(self):
+        return self.done.is_set() and self.outcome[1] is not None
+
+    def ensure_started(self):
+        """Lance la préparation si elle n'a pas encore eu lieu, ou la relance si elle a échoué"""
+        with self.lock:
+            if self.failed_before():
+                # Index illisible ou en cours de reconstruction au lancement : on réessaie
+                self.wait()
+                self.done.clear()
+            if not self.isRunning() and not self.done.is_set():
+                self.start()
+
+    def result(self):
+        """Reconnaisseur prêt à l'emploi, en attendant la fin de la préparation si besoin"""
+        self.done.wait()
+        recognizer, error = self.outcome
+        if error is not None:
+            raise RuntimeError(error)
+        return recognizer
+
+    def run(self):
+        try:
+            with span("warm_up"):
+                import numpy as np
+                from generate_spectrogram import SpectrogramGenerator
+                from recognition import Recognizer
+                import mixer
+
+                generator = SpectrogramGenerator(self.base_folder)
+                # "features" : résumé spectral de la chanson, "landmarks" : paires de pics (style Shazam)
+                recognizer = Recognizer(generator, match_mode="features")
+                recognizer.refresh()
+                recognizer.index
+
+                sr = 44100
+                t = np.arange(2 * sr) / sr
+                y = (0.5 * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+                recognizer.rank(recognizer.fingerprint_audio(y, sr))[:1]
+                mixer.StreamingMelSpectrogram(sr)
+        except Exception as e:
+            self.outcome = (None, str(e))
+            self.done.set()
+            self.failed.emit(str(e))
+            return
+        self.outcome = (recognizer, None)
+        self.done.set()
+        self.ready.emit(recognizer)
+
+
 class ModernLabel(QLabel):
     """Label stylisé avec police moderne et espacement"""
 
@@ -296,18 +552,55 @@ class Shazam(QMainWindow):
         self.first_song_path = None
         self.second_song_path = None
         self.animation_group = None
+        self.current_worker = None
+        self.mix_preview = None
+        self.workers = set()
 
         
         self.setupUi()
 
         
+        # Moteur de reconnaissance préparé en arrière-plan après la première image (start_warm_up)
         self.base_folder = self.get_base_folder()
-        self.generator = SpectrogramGenerator(self.base_folder)
+        self.generator = None
+        self.recognizer = None
+        self.warm_up = WarmUpWorker(self.base_folder)
+        self.warm_up.ready.connect(self.on_engine_ready)
+        self.warm_up.failed.connect(self.on_engine_failed)
+        self.first_paint_done = False
 
         
         self.loading_overlay = LoadingOverlay(self)
         self.loading_overlay.resize(self.size())
 
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.first_paint_done:
+            self.first_paint_done = True
+            self.report_startup("first_paint", "fenêtre affichée")
+            QTimer.singleShot(0, self.start_warm_up)
+
+    def report_startup(self, stage, description):
+        elapsed = time.perf_counter() - STARTED
+        STAGE_SECONDS.observe(elapsed, stage=f"startup_{stage}")
+        print(f"Démarrage : {description} après {elapsed:.2f} s")
+
+    def start_warm_up(self):
+        self.warm_up.ensure_started()
+
+    def on_engine_ready(self, recognizer):
+        self.recognizer = recognizer
+        self.generator = recognizer.generator
+        self.report_startup("ready", "prêt pour une reconnaissance")
+
+    def on_engine_failed(self, message):
+        QMessageBox.critical(self, "Erreur", f"Impossible de préparer la reconnaissance: {message}")
+
+    def wait_for_engine(self):
+        """Reconnaisseur prêt à l'emploi ; une demande faite pendant la préparation attend sa fin"""
+        self.start_warm_up()
+        return self.warm_up.result()
+
     def setupUi(self):
         
         central_widget = QWidget()
@@ -408,6 +701,7 @@ class Shazam(QMainWindow):
         self.mixer_slider = ModernSlider(Qt.Horizontal)
         self.mixer_slider.setValue(50)
         self.mixer_slider.valueChanged.connect(self.update_slider_labels)
+        self.mixer_slider.valueChanged.connect(self.preview_mix)
         self.mixer_slider.sliderReleased.connect(self.mix_songs)
 
         slider_layout.addLayout(slider_labels_layout)
@@ -461,15 +755,16 @@ class Shazam(QMainWindow):
         table_label = ModernLabel("Correspondances similaires:", is_subtitle=True)
         layout.addWidget(table_label)
 
-        self.results_table = ModernTableWidget(0, 3)
-        self.results_table.setHorizontalHeaderLabels(["Titre de la chanson", "Pourcentage de similarité", "Statut"])
+        self.results_model = ResultsTableModel(self)
+        self.results_table = ModernTableView()
+        self.results_table.setModel(self.results_model)
         self.results_table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
         self.results_table.verticalHeader().setVisible(False)
-        self.results_table.setEditTriggers(QTableWidget.NoEditTriggers)
-        self.results_table.setSelectionBehavior(QTableWidget.SelectRows)
+        self.results_table.setEditTriggers(QTableView.NoEditTriggers)
+        self.results_table.setSelectionBehavior(QTableView.SelectRows)
         self.results_table.setAlternatingRowColors(True)
         self.results_table.setStyleSheet(self.results_table.styleSheet() + f"""
-            QTableWidget::item:alternate {{
+            QTableView::item:alternate {{
                 background-color: {COLORS["hover"]};
             }}
         """)
@@ -500,162 +795,78 @@ class Shazam(QMainWindow):
             self.loading_overlay.show()
 
             
-            QTimer.singleShot(100, lambda: self.process_uploaded_song(file_path))
+            self.process_uploaded_song(file_path)
 
     def process_uploaded_song(self, file_path):
-        try:
-            
-            S_DB = self.generator.generate_spectrogram(file_path)
-            features = self.generator.extract_features(S_DB)
-            uploaded_fingerprint = self.generator.perceptual_hash(features)
-
-            
-            similarity_scores = self.find_similar_songs(uploaded_fingerprint)
-
-            
-            QTimer.singleShot(500, lambda: self.update_table(similarity_scores))
-
-        except Exception as e:
-            self.loading_overlay.hide()
-            QMessageBox.critical(self, "Erreur", f"Une erreur s'est produite lors du traitement: {str(e)}")
+        self.start_task(self.recognize_file, file_path)
+
+    def recognize_file(self, report, file_path):
+        """Reconnaissance complète d'un fichier (exécutée dans un RecognitionWorker)"""
+        return self.wait_for_engine().rank_file(file_path, report=lambda stage: report(STAGE_MESSAGES[stage]))
+
+    def start_task(self, fn, *args):
+        """Lance fn dans un thread de travail, en annulant la tâche précédente encore en cours"""
+        self.cancel_current_task()
+
+        worker = RecognitionWorker(fn, *args)
+        worker.progress.connect(self.loading_overlay.setMessage)
+        worker.succeeded.connect(lambda results: self.on_task_succeeded(worker, results))
+        worker.failed.connect(lambda message: self.on_task_failed(worker, message))
+        worker.finished.connect(lambda: self.workers.discard(worker))
+        self.workers.add(worker)
+        self.current_worker = worker
+        worker.start()
+
+    def cancel_current_task(self):
+        if self.current_worker is not None:
+            self.current_worker.cancel()
+            self.current_worker = None
+
+    def on_task_succeeded(self, worker, results):
+        if worker is self.current_worker:
+            self.current_worker = None
+            self.update_table(results)
+
+    def on_task_failed(self, worker, message):
+        if worker is not self.current_worker:
+            return
+        self.current_worker = None
+        self.loading_overlay.hide()
+        QMessageBox.critical(self, "Erreur", f"Une erreur s'est produite lors du traitement: {message}")
 
     def find_similar_songs(self, uploaded_fingerprint):
-        similarity_scores = []
+        return self.wait_for_engine().find_similar_songs(uploaded_fingerprint)
 
-        for file in os.listdir(self.generator.output_path):
-            if file.endswith('.json'):
-                try:
-                    with open(os.path.join(self.generator.output_path, file), 'r') as f:
-                        data = json.load(f)
-
-                    if "features" in data:
-                        similarity = self.compute_similarity(uploaded_fingerprint, data)
-                        similarity_percentage = min(similarity * 100, 100)
-                        similarity_scores.append((file, similarity_percentage))
-                    else:
-                        print(f"Structure d'empreinte invalide dans {file}: {data}")
-                        continue
-
-                except Exception as e:
-                    print(f"Erreur lors du traitement de {file}: {str(e)}")
-
-        
-        similarity_scores.sort(key=lambda x: x[1], reverse=True)
-
-        return similarity_scores
+    def get_index(self):
+        """Index des empreintes, ouvert une seule fois puis gardé en mémoire (memmap)"""
+        return self.wait_for_engine().index
 
     def compute_similarity(self, fingerprint1, fingerprint2):
-        def cosine_similarity(vec1, vec2):
-            """
-            Calculer la similarité cosinus pour les vecteurs.
-            Si les entrées sont des scalaires, calculer une similarité basée sur la différence.
-            """
-            if isinstance(vec1, (int, float)) and isinstance(vec2, (int, float)):
-                
-                return 1 - abs(vec1 - vec2) / (abs(vec1) + abs(vec2) + 1e-8)
-
-            
-            vec1 = np.array(vec1)
-            vec2 = np.array(vec2)
-            if vec1.ndim > 1:
-                vec1 = vec1.flatten()
-            if vec2.ndim > 1:
-                vec2 = vec2.flatten()
-            return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2) + 1e-8)
-
-        def hamming_distance(hash1, hash2):
-            """
-            Calculer la distance de Hamming entre deux hachages perceptuels.
-            Retourne un score de similarité normalisé entre 0 et 1.
-            """
-            return 1 - (sum(c1 != c2 for c1, c2 in zip(hash1, hash2)) / len(hash1))
-
-        similarities = []
-
-        
-        feature_keys = ["spectral_centroid_mean", "spectral_bandwidth_mean", "spectral_contrast_mean",
-                        "spectral_rolloff_mean", "tonnetz_mean", "zero_crossing_rate_mean"]
-        mfcc_keys = [f'mfcc_{i}_mean' for i in range(13)]
-        feature_keys.extend(mfcc_keys)
-
-        weights = {
-            "spectral_centroid_mean": 0.15,
-            "spectral_bandwidth_mean": 0.10,
-            "spectral_contrast_mean": 0.10,
-            "spectral_rolloff_mean": 0.10,
-            "tonnetz_mean": 0.15,
-            "zero_crossing_rate_mean": 0.10
-        }
-        
-        for i in range(13):
-            weights[f'mfcc_{i}_mean'] = 0.02 * (1.25 if i == 0 else 1)
-
-        
-        for key in feature_keys:
-            if key in fingerprint1["features"] and key in fingerprint2["features"]:
-                sim = cosine_similarity(fingerprint1["features"][key], fingerprint2["features"][key])
-                weight = weights.get(key, 0.05)  
-                similarities.append(weight * sim)
-
-        
-        if "phash" in fingerprint1 and "phash" in fingerprint2:
-            phash_sim = hamming_distance(fingerprint1["phash"], fingerprint2["phash"])
-            phash_weight = 0.10  
-            similarities.append(phash_weight * phash_sim)
-
-        
-        total_similarity = sum(similarities)
-        return total_similarity
+        from similarity import compute_similarity
+        return compute_similarity(fingerprint1, fingerprint2)
 
     def get_similarity_status(self, similarity):
-        if similarity >= 80:
-            return ("Élevée", COLORS["success"])
-        elif similarity >= 20:
-            return ("Moyenne", COLORS["warning"])
-        else:
-            return ("Faible", COLORS["error"])
+        return similarity_status(similarity)
 
-    def update_table(self, similarity_scores):
+    def update_table(self, similarity_scores, animate=True):
+        with timed("ui_update"), span("update_table", rows=len(similarity_scores)):
+            self.show_results(similarity_scores, animate)
+
+    def show_results(self, similarity_scores, animate=True):
         
         self.loading_overlay.hide()
 
         
-        self.results_table.setRowCount(len(similarity_scores))
-
-        for i, (filename, similarity) in enumerate(similarity_scores):
-            
-            song_name = filename.replace('.json', '')
-            song_name = song_name[:-4] if song_name.endswith('_out') else song_name
-
-            
-            status, color = self.get_similarity_status(similarity)
-
-            
-            song_item = QTableWidgetItem(song_name)
-            similarity_item = QTableWidgetItem(f"{similarity:.2f}%")
-            status_item = QTableWidgetItem(status)
-
-            
-            song_item.setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-            similarity_item.setTextAlignment(Qt.AlignCenter)
-            status_item.setTextAlignment(Qt.AlignCenter)
+        self.results_model.set_results(similarity_scores)
 
-            
-            status_item.setForeground(QColor(color))
+        if len(similarity_scores):
+            self.song_name_card.show()
 
             
-            self.results_table.setItem(i, 0, song_item)
-            self.results_table.setItem(i, 1, similarity_item)
-            self.results_table.setItem(i, 2, status_item)
+            self.song_name_label.setText(ResultsTableModel.song_name(similarity_scores[0][0]))
 
             
-            if i == 0:
-                self.song_name_card.show()
-
-                
-                self.song_name_label.setText(song_name)
-
-                
+            if animate:
                 self.animate_recognition_result()
 
     def animate_recognition_result(self):
@@ -684,6 +895,7 @@ class Shazam(QMainWindow):
             self.first_song_path = file_path
             song_name = os.path.splitext(os.path.basename(file_path))[0]
             self.upload_first_song_label.setText(f"'{song_name}' chargé avec succès")
+            self.start_mix_preview()
 
     def upload_second_song_file(self):
         file_path, _ = QFileDialog.getOpenFileName(
@@ -694,11 +906,65 @@ class Shazam(QMainWindow):
             self.second_song_path = file_path
             song_name = os.path.splitext(os.path.basename(file_path))[0]
             self.upload_second_song_label.setText(f"'{song_name}' chargé avec succès")
+            self.start_mix_preview()
+
+    def start_mix_preview(self):
+        """Prépare l'aperçu du mixage dès que les deux chansons sont chargées"""
+        self.stop_mix_preview()
+        if not self.first_song_path or not self.second_song_path:
+            return
+
+        first_song_path, second_song_path = self.first_song_path, self.second_song_path
+
+        def make_session():
+            from mixer import MixSession
+            recognizer = self.wait_for_engine()
+            return MixSession(recognizer, first_song_path, second_song_path,
+                              recognizer.generator.offset, recognizer.generator.duration)
+
+        worker = MixPreviewWorker(make_session)
+        worker.ready.connect(lambda mix_ratio, ranking: self.on_mix_preview_ready(worker, ranking))
+        worker.failed.connect(lambda message: self.on_mix_preview_failed(worker, message))
+        worker.finished.connect(lambda: self.workers.discard(worker))
+        self.workers.add(worker)
+        self.mix_preview = worker
+
+        self.loading_overlay.resize(self.size())
+        self.loading_overlay.setMessage("Mixage en cours...")
+        self.loading_overlay.show()
+        worker.start()
+        worker.request(self.mixer_slider.value() / 100.0)
+
+    def stop_mix_preview(self):
+        if self.mix_preview is not None:
+            self.mix_preview.stop()
+            self.mix_preview = None
+
+    def preview_mix(self):
+        if self.mix_preview is not None:
+            self.mix_preview.request(self.mixer_slider.value() / 100.0)
+
+    def on_mix_preview_ready(self, worker, ranking):
+        if worker is self.mix_preview:
+            # Le mixage remplace le résultat d'une reconnaissance encore en cours
+            self.cancel_current_task()
+            self.update_table(ranking, animate=False)
+
+    def on_mix_preview_failed(self, worker, message):
+        if worker is not self.mix_preview:
+            return
+        # Sans aperçu, le relâchement du curseur repasse par le mixage complet
+        self.mix_preview = None
+        self.loading_overlay.hide()
+        QMessageBox.critical(self, "Erreur", f"Une erreur s'est produite lors du mixage: {message}")
 
     def mix_songs(self):
-        if not hasattr(self, 'first_song_path') or not hasattr(self, 'second_song_path'):
+        if not self.first_song_path or not self.second_song_path:
             QMessageBox.warning(self, "Attention", "Veuillez d'abord charger les deux chansons à mixer.")
             return
+        if self.mix_preview is not None:
+            # Le tableau suit déjà le curseur
+            return
 
         
         self.loading_overlay.resize(self.size())
@@ -706,53 +972,40 @@ class Shazam(QMainWindow):
         self.loading_overlay.show()
 
         
-        QTimer.singleShot(100, self._mix_songs_process)
-
-    def _mix_songs_process(self):
-        try:
-            
-            y1, sr1 = librosa.load(self.first_song_path, sr=None)
-            y2, sr2 = librosa.load(self.second_song_path, sr=None)
-
-            
-            if sr1 != sr2:
-                sr_common = min(sr1, sr2)
-                y1 = librosa.resample(y1, orig_sr=sr1, target_sr=sr_common)
-                y2 = librosa.resample(y2, orig_sr=sr2, target_sr=sr_common)
-                sr1 = sr_common
-
-            
-            min_length = min(len(y1), len(y2))
-            y1 = y1[:min_length]
-            y2 = y2[:min_length]
-
-            
-            mix_ratio = self.mixer_slider.value() / 100.0
-            y_mixed = (1 - mix_ratio) * y2 + mix_ratio * y1
-            y_mixed /= np.max(np.abs(y_mixed))  
-
-            
-            mixed_song_path = os.path.join(BASE_DIR, "mixed_songs")
-            os.makedirs(mixed_song_path, exist_ok=True)
-
-            
-            mixed_file = os.path.join(mixed_song_path, 'mixage_resultat.wav')
-            sf.write(mixed_file, y_mixed, sr1)
-
-            
-            QTimer.singleShot(100, lambda: self.process_uploaded_song(mixed_file))
-
-        except Exception as e:
-            self.loading_overlay.hide()
-            QMessageBox.critical(self, "Erreur", f"Échec du mixage : {str(e)}")
-        finally:
-            
-            QTimer.singleShot(500, self.loading_overlay.hide)
+        mix_ratio = self.mixer_slider.value() / 100.0
+        self.start_task(self.mix_and_recognize, self.first_song_path, self.second_song_path, mix_ratio)
+
+    def mix_and_recognize(self, report, first_song_path, second_song_path, mix_ratio):
+        """Mixage des deux chansons puis reconnaissance du résultat (exécuté dans un RecognitionWorker)"""
+        from mixer import mix_streams
+        recognizer = self.wait_for_engine()
+        report("Mixage en cours...")
+        # Mixage en flux : les blocs mixés vont directement à l'analyse, sans fichier intermédiaire
+        sr, mixed_blocks = mix_streams(first_song_path, second_song_path, mix_ratio,
+                                       recognizer.generator.offset, recognizer.generator.duration)
+        return recognizer.rank_stream(mixed_blocks, sr, report=lambda stage: report(STAGE_MESSAGES[stage]))
+
+    def closeEvent(self, event):
+        self.cancel_current_task()
+        self.stop_mix_preview()
+        for worker in [*self.workers, self.warm_up]:
+            worker.wait()
+        # Lancé avec SHAZAM_TRACE=fichier.json : chronologie de toutes les reconnaissances
+        if tracing.enabled():
+            tracing.write()
+        # Lancé avec SHAZAM_METRICS=fichier.prom : durées de chaque étape, au format texte Prometheus
+        if os.environ.get(METRICS_ENV):
+            REGISTRY.write(os.environ[METRICS_ENV])
+        super().closeEvent(event)
 
     def get_base_folder(self):
         return os.path.join(BASE_DIR, "Task_5_Data")
 
     def reset(self):
+        self.cancel_current_task()
+        self.stop_mix_preview()
+        self.loading_overlay.hide()
+
         
         self.uploaded_song_path = None
         self.first_song_path = None
@@ -768,7 +1021,7 @@ class Shazam(QMainWindow):
         self.update_slider_labels()
 
         
-        self.results_table.setRowCount(0)
+        self.results_model.clear()
         self.song_name_card.hide()
 
         
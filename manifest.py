@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+
+
+MANIFEST_FILENAME = "manifest.jsonl"
+
+
+def file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class IngestManifest:
+    """
+    Record of the files already fingerprinted.
+
+    The manifest is an append-only JSON-lines log: every processed file appends one
+    record (path, size, mtime, content hash, fingerprint version) once its fingerprint
+    is on disk, so an interrupted run resumes after the last committed file. Removed
+    files append a tombstone. The last record of a path wins, and compact() rewrites
+    the log with only the live entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash can leave a truncated last line: that file is simply redone.
+                        continue
+                    if record.get("removed"):
+                        self.entries.pop(record["path"], None)
+                    else:
+                        self.entries[record["path"]] = record
+
+    def is_current(self, key, file_path, stat, version):
+        """
+        Whether file_path was already fingerprinted with this version and has not changed since.
+        The content hash is only computed when size or mtime differ from the record.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry["fingerprint_version"] != version:
+            return False
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return True
+        if entry["size"] == stat.st_size and entry["sha256"] == file_sha256(file_path):
+            # Touched but identical: remember the new mtime so the file is not hashed again.
+            self.commit(key, entry["name"], stat, entry["sha256"], version)
+            return True
+        return False
+
+    def commit(self, key, name, stat, sha256, version):
+        record = {
+            "path": key,
+            "name": name,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha256": sha256,
+            "fingerprint_version": version,
+        }
+        self._append(record)
+        self.entries[key] = record
+
+    def remove(self, key):
+        self._append({"path": key, "removed": True})
+        self.entries.pop(key, None)
+
+    def _append(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compact(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            for key in sorted(self.entries):
+                f.write(json.dumps(self.entries[key]) + "\n")
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,200 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# File the GUI writes its metrics to on exit (the CLIs take --metrics, the service serves /metrics).
+METRICS_ENV = "SHAZAM_METRICS"
+# Latency buckets in seconds, from sub-millisecond index lookups to multi-second decodes.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count, one value per combination of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def _state(self, reset):
+        with self._lock:
+            state = dict(self._values)
+            if reset:
+                self._values.clear()
+        return state
+
+    def _merge(self, state):
+        with self._lock:
+            for key, value in state.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+    def _samples(self):
+        for key, value in sorted(self._state(False).items()):
+            yield self.name + _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """Distribution of observed durations (or any values) in cumulative buckets, with their sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (+Inf last, not cumulative), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        entry = self._values.get(tuple(labels[name] for name in self.labelnames))
+        return sum(entry[0]) if entry else 0
+
+    def _state(self, reset):
+        with self._lock:
+            state = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+            if reset:
+                self._values.clear()
+        return state
+
+    def _merge(self, state):
+        with self._lock:
+            for key, (counts, total) in state.items():
+                entry = self._values.get(key)
+                if entry is None:
+                    entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+
+    def _samples(self):
+        for key, (counts, total) in sorted(self._state(False).items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                yield (self.name + "_bucket"
+                       + _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))]), cumulative)
+            yield self.name + "_sum" + _format_labels(self.labelnames, key), total
+            yield self.name + "_count" + _format_labels(self.labelnames, key), cumulative
+
+
+class MetricsRegistry:
+    """
+    Named metrics of one process, exported in the Prometheus text exposition format.
+
+    Worker processes record into their own registry and hand it over with drain(); the
+    parent adds it to its own with merge(), so pool work shows up in one export.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered with another type or labels")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def drain(self):
+        """Picklable state of every metric, which is then reset."""
+        return {name: metric._state(True) for name, metric in self._metrics.items()}
+
+    def reset(self):
+        """Forget every recorded value, for instance what a forked worker inherited from its parent."""
+        self.drain()
+
+    def merge(self, state):
+        for name, values in state.items():
+            metric = self._metrics.get(name)
+            if metric is not None:
+                metric._merge(values)
+
+    def exposition(self):
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(f"{sample} {_format_value(value)}" for sample, value in metric._samples())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Dump the exposition to a file (for node_exporter's textfile collector, for instance)."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.exposition())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "shazam_stage_seconds", "Time spent in each recognition stage.", ["stage"])
+FEATURE_SECONDS = REGISTRY.histogram(
+    "shazam_feature_seconds", "Time spent computing each summarized feature.", ["feature"])
+SKIPPED_FINGERPRINTS = REGISTRY.counter(
+    "shazam_fingerprint_files_skipped_total", "Fingerprint files left out of the index.", ["reason"])
+REQUESTS = REGISTRY.counter(
+    "shazam_requests_total", "Requests answered by the recognition service.", ["route", "status"])
+
+
+def timed(stage):
+    """Context manager recording the duration of a recognition stage."""
+    return STAGE_SECONDS.time(stage=stage)
@@ -0,0 +1,183 @@
+import librosa
+import numpy as np
+import soundfile as sf
+import soxr
+
+from metrics import timed
+from result_cache import audio_digest
+
+
+BLOCK_FRAMES = 65536
+
+# melspectrogram defaults, which spectrogram_from_audio relies on.
+N_FFT = 2048
+HOP_LENGTH = 512
+
+
+def read_blocks(path, offset=0.0, duration=None, block_frames=BLOCK_FRAMES):
+    """
+    Decode a window of an audio file block by block, downmixed to mono float32.
+    The window is measured like librosa.load measures it.
+    :return: (sample rate, generator of blocks)
+    """
+    info = sf.info(path)
+    start = int(np.round(info.samplerate * offset))
+    stop = None if duration is None else start + int(np.round(info.samplerate * duration))
+
+    def blocks():
+        with sf.SoundFile(path) as f:
+            if start:
+                f.seek(min(start, f.frames))
+            remaining = None if stop is None else max(stop - start, 0)
+            while remaining is None or remaining > 0:
+                count = block_frames if remaining is None else min(block_frames, remaining)
+                block = f.read(count, dtype="float32", always_2d=True)
+                if not len(block):
+                    break
+                if remaining is not None:
+                    remaining -= len(block)
+                yield block.mean(axis=1, dtype=np.float32) if block.shape[1] > 1 else block[:, 0]
+
+    return info.samplerate, blocks()
+
+
+def resample_blocks(blocks, orig_sr, target_sr):
+    """Resample a stream of mono blocks with a streaming soxr resampler (librosa's default quality)."""
+    if orig_sr == target_sr:
+        yield from blocks
+        return
+    stream = soxr.ResampleStream(orig_sr, target_sr, 1, dtype="float32", quality="HQ")
+    for block in blocks:
+        out = stream.resample_chunk(block)
+        if len(out):
+            yield out
+    out = stream.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+    if len(out):
+        yield out
+
+
+def mix_blocks(first, second, mix_ratio):
+    """
+    Weighted sum of two block streams, mix_ratio * first + (1 - mix_ratio) * second,
+    cut at the end of the shortest one. Blocks of both sides need not line up.
+    """
+    pending = [np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32)]
+    streams = [iter(first), iter(second)]
+    while True:
+        for i, stream in enumerate(streams):
+            if not len(pending[i]):
+                block = next(stream, None)
+                if block is None:
+                    return
+                pending[i] = block
+        n = min(len(pending[0]), len(pending[1]))
+        yield (1 - mix_ratio) * pending[1][:n] + mix_ratio * pending[0][:n]
+        pending = [pending[0][n:], pending[1][n:]]
+
+
+def mix_streams(first_path, second_path, mix_ratio, offset=0.0, duration=None, block_frames=BLOCK_FRAMES):
+    """
+    Stream the mix of the analysis windows of two files, at the lower of their sample
+    rates. Only a few blocks are ever in memory, whatever the length of the files.
+    :return: (sample rate, generator of mixed blocks, not normalized)
+    """
+    sr1, first = read_blocks(first_path, offset, duration, block_frames)
+    sr2, second = read_blocks(second_path, offset, duration, block_frames)
+    sr = min(sr1, sr2)
+    return sr, mix_blocks(resample_blocks(first, sr1, sr), resample_blocks(second, sr2, sr), mix_ratio)
+
+
+class StreamingMelSpectrogram:
+    """
+    Mel power spectrogram computed block by block, frame for frame the one of
+    librosa.feature.melspectrogram(y=y, sr=sr) on the concatenated blocks (centered,
+    zero-padded frames). Only the last frame's worth of samples is buffered.
+    """
+
+    def __init__(self, sr, n_fft=N_FFT, hop_length=HOP_LENGTH):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft)
+        self.buffer = np.zeros(n_fft // 2, dtype=np.float32)
+        self.frames = []
+
+    def push(self, block):
+        self.buffer = np.concatenate([self.buffer, block])
+        self._emit()
+
+    def _emit(self):
+        n_frames = 1 + (len(self.buffer) - self.n_fft) // self.hop_length if len(self.buffer) >= self.n_fft else 0
+        if not n_frames:
+            return
+        used = self.n_fft + (n_frames - 1) * self.hop_length
+        S = np.abs(librosa.stft(self.buffer[:used], n_fft=self.n_fft, hop_length=self.hop_length,
+                                center=False)) ** 2
+        self.frames.append(np.einsum("...ft,mf->...mt", S, self.mel_basis, optimize=True))
+        self.buffer = self.buffer[n_frames * self.hop_length:]
+
+    def finish(self):
+        self.buffer = np.concatenate([self.buffer, np.zeros(self.n_fft // 2, dtype=np.float32)])
+        self._emit()
+        if not self.frames:
+            return np.zeros((len(self.mel_basis), 0), dtype=np.float32)
+        return np.concatenate(self.frames, axis=1)
+
+
+class MixSession:
+    """
+    Mixes of two songs at any ratio, without touching audio again.
+
+    Both analysis windows are decoded and resampled once, and their complex STFTs are
+    kept: the STFT being linear, the spectrogram of a mix is the same mix of the two
+    STFTs. Each rank() then only costs the mel projection, the features and the search.
+    A ratio gives the same cache key as mix_streams on the same files, so both paths
+    share cached rankings.
+    """
+
+    def __init__(self, recognizer, first_path, second_path, offset=0.0, duration=None):
+        self.recognizer = recognizer
+        sr1, first = read_blocks(first_path, offset, duration)
+        sr2, second = read_blocks(second_path, offset, duration)
+        self.sr = min(sr1, sr2)
+        y1 = np.concatenate([np.zeros(0, dtype=np.float32), *resample_blocks(first, sr1, self.sr)])
+        y2 = np.concatenate([np.zeros(0, dtype=np.float32), *resample_blocks(second, sr2, self.sr)])
+        n = min(len(y1), len(y2))
+        self.y1, self.y2 = y1[:n], y2[:n]
+
+        self.landmarks = recognizer.uses_landmarks()
+        if not self.landmarks:
+            self.S1 = librosa.stft(self.y1, n_fft=N_FFT, hop_length=HOP_LENGTH)
+            self.S2 = librosa.stft(self.y2, n_fft=N_FFT, hop_length=HOP_LENGTH)
+            self.mel_basis = librosa.filters.mel(sr=self.sr, n_fft=N_FFT)
+
+    def mixed_audio(self, mix_ratio):
+        return (1 - mix_ratio) * self.y2 + mix_ratio * self.y1
+
+    def rank(self, mix_ratio):
+        """:return: RankedMatches of the catalog for the mix at mix_ratio."""
+        recognizer = self.recognizer
+        generator = recognizer.generator
+        y = self.mixed_audio(mix_ratio)
+        key = recognizer.cache_key(audio_digest(y, self.sr))
+        ranking = recognizer.result_cache.get(key)
+        if ranking is not None:
+            return ranking
+
+        peak = float(np.max(np.abs(y), initial=0.0))
+        scale = 1 / peak if peak > 0 else 1.0
+        if self.landmarks:
+            with timed("landmarks"):
+                fingerprint = generator.landmark_fingerprint(y * scale, self.sr)
+        else:
+            with timed("mel_spectrogram"):
+                S = (1 - mix_ratio) * self.S2 + mix_ratio * self.S1
+                mel = np.einsum("...ft,mf->...mt", np.abs(S) ** 2, self.mel_basis, optimize=True)
+                S_DB = generator.spectrogram_from_power(mel * scale ** 2)
+            with timed("features"):
+                features = generator.extract_features(S_DB)
+            with timed("hashing"):
+                fingerprint = generator.perceptual_hash(features)
+
+        ranking = recognizer.rank(fingerprint)
+        recognizer.result_cache.put(key, ranking)
+        return ranking
@@ -0,0 +1,113 @@
+import re
+from functools import lru_cache
+
+import numpy as np
+
+
+CODE_BITS = 64
+CODE_WORDS = CODE_BITS // 64
+CODE_HEX_LENGTH = CODE_BITS // 4
+# Changing the seed or the reference statistics changes every code: bump FINGERPRINT_VERSION.
+CODE_SEED = 20240917
+
+# Fixed standardization of the feature vector (FEATURE_KEYS order), measured once on the
+# reference catalog. Codes must not depend on the catalog they are compared against.
+REFERENCE_CENTER = np.array([
+    2338.0, 2023.0, 10.15, 4425.0, 9.132e-05, 0.0,
+    -570.8, 123.0, -12.18, 23.37, -4.043, 4.622, -4.919, -2.663, -3.719, -3.122, -4.083, -2.966, -3.924,
+])
+REFERENCE_SCALE = np.array([
+    768.9, 411.2, 1.657, 1230.0, 0.005743, 1.0,
+    77.34, 53.72, 28.83, 19.93, 17.95, 17.19, 14.2, 11.98, 11.12, 12.05, 8.202, 7.66, 7.237,
+])
+
+# Random hyperplanes through the reference center: one code bit per hyperplane.
+HYPERPLANES = np.random.default_rng(CODE_SEED).standard_normal((len(REFERENCE_CENTER), CODE_BITS))
+
+_HEX_CODE = re.compile(f"[0-9a-f]{{{CODE_HEX_LENGTH}}}")
+
+
+def perceptual_code(vector):
+    """
+    SimHash of a feature vector: the side of every hyperplane it falls on, packed into
+    uint64 words. Nearby feature vectors share most bits, so the Hamming distance of two
+    codes estimates the angle between their standardized features.
+    :param vector: Feature vector(s) in FEATURE_KEYS order, NaN for missing features.
+    :return: (..., CODE_WORDS) uint64 array.
+    """
+    standardized = np.nan_to_num((np.asarray(vector, dtype=np.float64) - REFERENCE_CENTER) / REFERENCE_SCALE)
+    bits = standardized @ HYPERPLANES > 0
+    packed = np.packbits(bits, axis=-1, bitorder="little")
+    return np.ascontiguousarray(packed).view("<u8")
+
+
+def code_to_hex(code):
+    return "".join(f"{int(word):016x}" for word in code)
+
+
+def hex_to_code(text):
+    """Parse a hex code, or None if text is not one (such as the SHA-256 phashes of old fingerprints)."""
+    if not isinstance(text, str) or not _HEX_CODE.fullmatch(text):
+        return None
+    return np.array([int(text[i:i + 16], 16) for i in range(0, CODE_HEX_LENGTH, 16)], dtype="<u8")
+
+
+def hamming_distances(query_code, codes):
+    """Number of differing bits between one code and every row of a (N, CODE_WORDS) array."""
+    return np.bitwise_count(np.asarray(codes) ^ np.asarray(query_code, dtype="<u8")).sum(axis=-1, dtype=np.int64)
+
+
+class MultiIndexHash:
+    """
+    Radius search over binary codes without scanning them all.
+
+    Codes are cut into 16-bit chunks and every chunk position gets its own sorted table.
+    Two codes within radius r of each other agree within r // n_chunks bits on at least
+    one chunk (pigeonhole), so a search only enumerates the chunk values that close to
+    the query's, looks them up, and checks the full distance of those candidates.
+    """
+
+    CHUNK_BITS = 16
+
+    def __init__(self, codes):
+        self.codes = np.ascontiguousarray(codes, dtype="<u8")
+        chunks = self.codes[..., None] >> (np.arange(64 // self.CHUNK_BITS, dtype=np.uint64) * np.uint64(self.CHUNK_BITS))
+        self.chunks = (chunks & np.uint64(2 ** self.CHUNK_BITS - 1)).reshape(len(self.codes), -1).astype(np.uint32)
+        # One contiguous sorted table per chunk position.
+        self.order = np.ascontiguousarray(np.argsort(self.chunks, axis=0, kind="stable").T)
+        self.sorted_chunks = np.take_along_axis(self.chunks.T, self.order, axis=1)
+
+    @property
+    def n_chunks(self):
+        return self.chunks.shape[1]
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _flip_masks(radius):
+        """Every chunk value with at most radius bits set."""
+        values = np.arange(2 ** MultiIndexHash.CHUNK_BITS, dtype=np.uint32)
+        return values[np.bitwise_count(values) <= radius]
+
+    def search(self, query_code, radius):
+        """
+        :return: (rows, distances) of every code within radius bits of the query, nearest first.
+        """
+        query_code = np.asarray(query_code, dtype="<u8")
+        query_chunks = MultiIndexHash(query_code[None, :]).chunks[0]
+        masks = self._flip_masks(radius // self.n_chunks)
+
+        candidates = []
+        for c in range(self.n_chunks):
+            values = query_chunks[c] ^ masks
+            left = np.searchsorted(self.sorted_chunks[c], values, side="left")
+            right = np.searchsorted(self.sorted_chunks[c], values, side="right")
+            counts = right - left
+            starts = np.repeat(left - (np.cumsum(counts) - counts), counts)
+            candidates.append(self.order[c, np.arange(int(counts.sum())) + starts])
+
+        rows = np.unique(np.concatenate(candidates))
+        distances = hamming_distances(query_code, self.codes[rows])
+        keep = distances <= radius
+        rows, distances = rows[keep], distances[keep]
+        order = np.argsort(distances, kind="stable")
+        return rows[order], distances[order]
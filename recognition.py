@@ -0,0 +1,345 @@
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from fingerprint_index import INDEX_FILENAME, load_index, features_to_vector, fingerprint_code
+from ivf_index import DEFAULT_NPROBE, IVF_FILENAME, load_ivf_index
+from mixer import StreamingMelSpectrogram
+from landmarks import LANDMARK_DIRNAME, LANDMARK_INDEX_FILENAME, SCORERS, load_landmark_index
+from metrics import REGISTRY, timed
+from perceptual_code import MultiIndexHash
+from result_cache import AudioDigest, ResultCache, audio_digest
+from similarity import CatalogScorer, top_k_indices
+import tracing
+from tracing import span
+
+
+# Feature index and its scorer, loaded together and replaced as one when the catalog changes.
+FeatureCatalog = namedtuple("FeatureCatalog", ["index", "scorer"])
+
+
+def match_to_dict(match):
+    """JSON form of a ranked match: name and similarity, plus the landmark details if any."""
+    if hasattr(match, "_asdict"):
+        return match._asdict()
+    return {"name": match[0], "similarity": match[1]}
+
+
+def fingerprint_file(generator, file_path, landmarks=False, report=None):
+    """
+    Fingerprint one audio file (a path or a binary file object).
+    Needs no index, so it can run in worker processes.
+    :param landmarks: Landmark fingerprint instead of the feature one.
+    """
+    report = report or (lambda message: None)
+    with span("fingerprint_file", file=str(getattr(file_path, "name", file_path))):
+        report("decode")
+        with timed("decode"):
+            y, sr = generator.load_audio(file_path)
+        return fingerprint_audio(generator, y, sr, landmarks, report)
+
+
+def fingerprint_audio(generator, y, sr, landmarks=False, report=None):
+    report = report or (lambda message: None)
+    if landmarks:
+        report("landmarks")
+        with timed("landmarks"):
+            return generator.landmark_fingerprint(y, sr)
+
+    with timed("mel_spectrogram"):
+        S_DB = generator.spectrogram_from_audio(y, sr)
+    report("features")
+    with timed("features"):
+        features = generator.extract_features(S_DB)
+    with timed("hashing"):
+        return generator.perceptual_hash(features)
+
+
+def reset_worker_telemetry():
+    """Pool initializer: drop the metrics and spans a forked worker inherited from its parent."""
+    REGISTRY.reset()
+    tracing.reset()
+
+
+def worker_telemetry():
+    """Metrics and spans recorded by a worker since its last job, to send back with the result."""
+    return REGISTRY.drain(), tracing.drain()
+
+
+def merge_worker_telemetry(telemetry):
+    metrics, events = telemetry
+    REGISTRY.merge(metrics)
+    tracing.merge(events)
+
+
+class RankedMatches:
+    """
+    Ranking of a whole catalog for one query, sorted lazily.
+
+    Indexing or slicing it only sorts and builds the matches up to the last position
+    asked for (via top-k selection, doubling as it grows), so showing the first rows
+    of a huge catalog does not pay for sorting or naming all of it.
+    """
+
+    def __init__(self, scores, make_match):
+        """
+        :param make_match: Builds the match tuple of a score position.
+        """
+        self.scores = scores
+        self.make_match = make_match
+        self._matches = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            stop = key.stop if key.stop is None or key.stop >= 0 else None
+        else:
+            stop = key + 1 if key >= 0 else None
+        self._extend(len(self) if stop is None else min(stop, len(self)))
+        return self._matches[key]
+
+    def _extend(self, count):
+        if count <= len(self._matches):
+            return
+        with timed("ranking"), span("top_k", k=count):
+            order = top_k_indices(self.scores, min(len(self), max(count, 2 * len(self._matches))))
+            self._matches.extend(self.make_match(i) for i in order[len(self._matches):])
+
+
+class Recognizer:
+    """
+    Recognition pipeline without any GUI dependency: fingerprint audio, then rank the catalog.
+
+    The indexes of the generator's fingerprint folder are opened on first use and kept.
+    :param match_mode: "features" (spectral summary) or "landmarks" (peak pairs, Shazam style).
+                       Landmark queries fall back to features while no landmark index exists.
+    :param nprobe: Clusters probed per feature query when the catalog has an IVF index,
+                   None for an exhaustive scan.
+
+    Rankings are cached by decoded audio content. Index files are checked on every query:
+    when the catalog is rebuilt, the indexes are reopened and the cached results dropped.
+    A Recognizer can be shared between threads: a query works on the indexes it started
+    with even if another thread refreshes them meanwhile.
+    """
+
+    def __init__(self, generator, match_mode="features", landmark_scorer=None, result_cache=None,
+                 nprobe=DEFAULT_NPROBE):
+        self.generator = generator
+        self.match_mode = match_mode
+        self.nprobe = nprobe
+        self.landmark_scorer = landmark_scorer or SCORERS["offset"]()
+        self.result_cache = result_cache if result_cache is not None else ResultCache()
+        self._lock = threading.Lock()
+        self._catalog = None
+        self._landmark_index = None
+        # (index, structure built for it): rebuilt when the index was reloaded since.
+        self._ivf = None
+        self._code_index = None
+        self._index_version = None
+
+    def catalog(self):
+        """FeatureCatalog of the fingerprint folder, loaded on first use."""
+        catalog = self._catalog
+        if catalog is None:
+            with self._lock:
+                catalog = self._catalog
+                if catalog is None:
+                    with timed("index_load"):
+                        index = load_index(self.generator.output_path)
+                        catalog = FeatureCatalog(index, CatalogScorer(index.features, index.phashes))
+                    self._catalog = catalog
+        return catalog
+
+    def _derived(self, attribute, index, build):
+        cached = getattr(self, attribute)
+        if cached is None or cached[0] is not index:
+            cached = (index, build())
+            setattr(self, attribute, cached)
+        return cached[1]
+
+    @property
+    def index(self):
+        return self.catalog().index
+
+    @property
+    def scorer(self):
+        return self.catalog().scorer
+
+    @property
+    def ivf(self):
+        """IVF index of the feature catalog, or None if it has none (small catalogs)."""
+        return self._ivf_of(self.index)
+
+    def _ivf_of(self, index):
+        return self._derived("_ivf", index,
+                             lambda: load_ivf_index(self.generator.output_path, len(index)) or False) or None
+
+    @property
+    def code_index(self):
+        """Multi-index hash table over the perceptual codes of the catalog."""
+        return self._code_index_of(self.index)
+
+    def _code_index_of(self, index):
+        return self._derived("_code_index", index, lambda: MultiIndexHash(index.phashes))
+
+    @property
+    def landmark_index(self):
+        """Landmark index, or None if the catalog was never indexed that way."""
+        landmark_index = self._landmark_index
+        if landmark_index is None:
+            landmark_index = self._landmark_index = load_landmark_index(self.generator.output_path)
+        return landmark_index
+
+    def index_version(self):
+        """(size, mtime) of the index files: changes whenever the catalog is rebuilt."""
+        version = []
+        for path in (os.path.join(self.generator.output_path, INDEX_FILENAME),
+                     os.path.join(self.generator.output_path, IVF_FILENAME),
+                     os.path.join(self.generator.output_path, LANDMARK_DIRNAME, LANDMARK_INDEX_FILENAME)):
+            try:
+                stat = os.stat(path)
+                version.append((stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def refresh(self):
+        """Reopen the indexes and forget cached results if the catalog changed on disk."""
+        version = self.index_version()
+        with self._lock:
+            if version != self._index_version:
+                # Queries in flight keep the catalog they already hold.
+                self._catalog = self._landmark_index = None
+                self.result_cache.clear()
+                self._index_version = version
+        return version
+
+    def cache_key(self, content_digest):
+        return (content_digest, self.generator.fingerprint_version, self.match_mode,
+                type(self.landmark_scorer).__name__, self.nprobe, self.refresh())
+
+    def uses_landmarks(self):
+        return self.match_mode == "landmarks" and self.landmark_index is not None
+
+    def fingerprint_file(self, file_path, report=None):
+        """
+        :param report: Optional callback receiving the name of each stage as it starts
+                       ("decode", "features" or "landmarks", then "search").
+        """
+        return fingerprint_file(self.generator, file_path, self.uses_landmarks(), report)
+
+    def fingerprint_audio(self, y, sr, report=None):
+        return fingerprint_audio(self.generator, y, sr, self.uses_landmarks(), report)
+
+    def find_similar_songs(self, fingerprint, top_k=None):
+        """
+        :return: [(track name, similarity percentage), ...] by decreasing similarity
+                 (LandmarkMatch tuples for landmark fingerprints), at most top_k of them.
+        """
+        return self.rank(fingerprint)[:top_k]
+
+    def rank(self, fingerprint):
+        """:return: RankedMatches of the catalog for a fingerprint."""
+        if "hashes" in fingerprint:
+            landmark_index = self.landmark_index
+            with timed("scoring"), span("score_landmarks"):
+                scores = landmark_index.score(fingerprint, self.landmark_scorer)
+            return RankedMatches(scores[0], lambda i: landmark_index.match(i, *scores))
+
+        index, scorer = self.catalog()
+        query_vector = features_to_vector(fingerprint["features"], np.float64)
+        rows = None
+        with timed("scoring"), span("score_catalog", tracks=len(scorer)):
+            ivf = self._ivf_of(index) if self.nprobe else None
+            if ivf is not None:
+                rows = np.sort(ivf.candidates(query_vector, self.nprobe))
+            scores = scorer.score(query_vector, fingerprint_code(fingerprint), rows)
+        similarity_percentages = np.minimum(scores * 100, 100)
+
+        if rows is not None:
+            return RankedMatches(similarity_percentages,
+                                 lambda i: (index.name(rows[i]), float(similarity_percentages[i])))
+        return RankedMatches(similarity_percentages, lambda i: (index.name(i), float(similarity_percentages[i])))
+
+    def near_duplicates(self, fingerprint, radius=4):
+        """
+        Catalog tracks whose perceptual code is within radius bits of the fingerprint's.
+        :return: [(track name, differing bits), ...] nearest first.
+        """
+        index = self.index
+        rows, distances = self._code_index_of(index).search(fingerprint_code(fingerprint), radius)
+        return [(index.name(i), int(d)) for i, d in zip(rows, distances)]
+
+    def recognize_file(self, file_path, top_k=None, report=None):
+        return self.rank_file(file_path, report)[:top_k]
+
+    def recognize_audio(self, y, sr, top_k=None, report=None):
+        return self.rank_audio(y, sr, report)[:top_k]
+
+    def rank_file(self, file_path, report=None):
+        if report:
+            report("decode")
+        with timed("decode"):
+            y, sr = self.generator.load_audio(file_path)
+        return self.rank_audio(y, sr, report)
+
+    def rank_stream(self, blocks, sr, report=None):
+        """
+        Rank a signal given as a stream of mono float32 blocks (see mixer.mix_streams).
+
+        Blocks go straight into the mel spectrogram instead of being gathered, and the
+        signal is peak-normalized afterwards by scaling its power spectrogram by the
+        squared running peak. Landmark matching still needs the whole signal.
+        """
+        report = report or (lambda message: None)
+        landmarks = self.uses_landmarks()
+        digest = AudioDigest()
+        mel = None if landmarks else StreamingMelSpectrogram(sr)
+        kept = []
+        peak = 0.0
+        for block in blocks:
+            digest.update(block)
+            peak = max(peak, float(np.max(np.abs(block), initial=0.0)))
+            if landmarks:
+                kept.append(block)
+            else:
+                mel.push(block)
+
+        key = self.cache_key(digest.hexdigest(sr))
+        ranking = self.result_cache.get(key)
+        if ranking is not None:
+            return ranking
+
+        scale = 1 / peak if peak > 0 else 1.0
+        if landmarks:
+            report("landmarks")
+            y = np.concatenate(kept) if kept else np.zeros(0, dtype=np.float32)
+            with timed("landmarks"):
+                fingerprint = self.generator.landmark_fingerprint(y * scale, sr)
+        else:
+            report("features")
+            with timed("mel_spectrogram"):
+                S_DB = self.generator.spectrogram_from_power(mel.finish() * scale ** 2)
+            with timed("features"):
+                features = self.generator.extract_features(S_DB)
+            with timed("hashing"):
+                fingerprint = self.generator.perceptual_hash(features)
+        report("search")
+        ranking = self.rank(fingerprint)
+        self.result_cache.put(key, ranking)
+        return ranking
+
+    def rank_audio(self, y, sr, report=None):
+        key = self.cache_key(audio_digest(y, sr))
+        ranking = self.result_cache.get(key)
+        if ranking is None:
+            fingerprint = self.fingerprint_audio(y, sr, report)
+            if report:
+                report("search")
+            ranking = self.rank(fingerprint)
+            self.result_cache.put(key, ranking)
+        return ranking
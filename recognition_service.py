@@ -0,0 +1,298 @@
+"""
+Local recognition service: keeps the fingerprint index in memory between requests.
+
+    python recognition_service.py --port 8765 --workers 4
+    python recognition_service.py --unix-socket /tmp/shazam.sock
+
+    POST /recognize?top_k=5   body: raw audio file bytes (wav, flac, ogg, mp3)
+    GET  /health
+    GET  /metrics             Prometheus text exposition of the stage timings
+
+Responses are JSON, except for /metrics. Decoding and fingerprinting run in a process
+pool, ranking runs against the warm index in the service process, concurrent uploads
+of the same audio share a single fingerprinting job and repeated ones are answered
+from the result cache. Nothing leaves the machine.
+"""
+import argparse
+import asyncio
+import hashlib
+import http.client
+import io
+import json
+import os
+import socket
+import time
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from generate_spectrogram import SpectrogramGenerator
+from ivf_index import DEFAULT_NPROBE
+import tracing
+from metrics import REGISTRY, REQUESTS, timed
+from recognition import (Recognizer, fingerprint_file, match_to_dict, merge_worker_telemetry,
+                         reset_worker_telemetry, worker_telemetry)
+from tracing import span
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_TOP_K = 5
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+ROUTES = ("/recognize", "/health", "/metrics")
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           411: "Length Required", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _fingerprint_bytes(generator, landmarks, data):
+    """Worker entry point: the metrics and spans recorded by the worker go back with the fingerprint."""
+    return fingerprint_file(generator, io.BytesIO(data), landmarks), worker_telemetry()
+
+
+class RecognitionService:
+    """
+    Recognition requests against an index loaded once.
+    :param workers: Size of the fingerprinting process pool.
+    """
+
+    def __init__(self, recognizer, workers=None):
+        self.recognizer = recognizer
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        # sha256 of the audio -> fingerprinting task shared by every request for it.
+        self._inflight = {}
+
+    def start(self):
+        self.recognizer.refresh()
+        self.recognizer.index
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=reset_worker_telemetry)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        if tracing.enabled():
+            print(f"Trace written to {tracing.write()}")
+
+    async def _fingerprint_job(self, data):
+        loop = asyncio.get_running_loop()
+        fingerprint, telemetry = await loop.run_in_executor(
+            self.pool, _fingerprint_bytes, self.recognizer.generator, self.recognizer.uses_landmarks(), data)
+        merge_worker_telemetry(telemetry)
+        return fingerprint
+
+    async def fingerprint(self, data, digest):
+        task = self._inflight.get(digest)
+        if task is None:
+            task = asyncio.ensure_future(self._fingerprint_job(data))
+            self._inflight[digest] = task
+            task.add_done_callback(lambda _: self._inflight.pop(digest, None))
+        # Shielded so that a client going away does not cancel the job for the others.
+        return await asyncio.shield(task)
+
+    async def recognize(self, data, top_k=DEFAULT_TOP_K):
+        start = time.perf_counter()
+        digest = hashlib.sha256(data).hexdigest()
+        # Uploads are keyed by their bytes, which spares decoding them to find a cached result.
+        key = self.recognizer.cache_key(f"upload:{digest}")
+        ranking = self.recognizer.result_cache.get(key)
+        if ranking is None:
+            try:
+                fingerprint = await self.fingerprint(data, digest)
+            except BrokenExecutor:
+                raise
+            except Exception as e:
+                # Only a bad upload is the client's fault: index or pool failures are 500s.
+                raise HttpError(400, f"could not decode the upload: {e}")
+            ranking = self.recognizer.rank(fingerprint)
+            self.recognizer.result_cache.put(key, ranking)
+        return {
+            "matches": [match_to_dict(match) for match in ranking[:top_k]],
+            "elapsed": time.perf_counter() - start,
+        }
+
+    def health(self):
+        return {"status": "ok", "tracks": len(self.recognizer.index), "in_flight": len(self._inflight)}
+
+    async def handle(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == "/health":
+            if method != "GET":
+                raise HttpError(405, "use GET")
+            return self.health()
+        if url.path == "/metrics":
+            if method != "GET":
+                raise HttpError(405, "use GET")
+            return REGISTRY.exposition()
+        if url.path == "/recognize":
+            if method != "POST":
+                raise HttpError(405, "use POST")
+            if not body:
+                raise HttpError(400, "empty audio upload")
+            try:
+                top_k = int(parse_qs(url.query).get("top_k", [DEFAULT_TOP_K])[0])
+            except ValueError:
+                raise HttpError(400, "top_k must be an integer")
+            with timed("request"), span("request", bytes=len(body), top_k=top_k):
+                return await self.recognize(body, top_k)
+        raise HttpError(404, f"no route for {url.path}")
+
+    async def serve_connection(self, reader, writer):
+        """Minimal HTTP/1.1 with keep-alive: only what the service and its client need."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                target = ""
+                try:
+                    try:
+                        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                        length = int(headers.get("content-length", 0))
+                    except ValueError:
+                        raise HttpError(400, "malformed request")
+                    if length > MAX_UPLOAD_BYTES:
+                        raise HttpError(413, f"uploads are limited to {MAX_UPLOAD_BYTES} bytes")
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = 200, await self.handle(method, target, body)
+                except HttpError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    raise
+                except Exception as e:
+                    status, payload = 500, {"error": f"internal error: {e}"}
+
+                route = urlsplit(target).path
+                REQUESTS.inc(route=route if route in ROUTES else "other", status=status)
+                if isinstance(payload, str):
+                    content, content_type = payload.encode(), "text/plain; version=0.0.4; charset=utf-8"
+                else:
+                    content, content_type = json.dumps(payload).encode(), "application/json"
+                close = status == 413 or headers.get("connection", "").lower() == "close"
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                             f"Content-Type: {content_type}\r\n"
+                             f"Content-Length: {len(content)}\r\n"
+                             f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode() + content)
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None):
+    service.start()
+    try:
+        if unix_socket:
+            server = await asyncio.start_unix_server(service.serve_connection, path=unix_socket)
+            address = unix_socket
+        else:
+            server = await asyncio.start_server(service.serve_connection, host, port)
+            address = f"http://{host}:{port}"
+        print(f"Recognition service on {address} ({len(service.recognizer.index)} tracks, "
+              f"{service.workers} workers)")
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class RecognitionClient:
+    """Blocking client of the local service, over TCP or a Unix socket."""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None, timeout=120):
+        if unix_socket:
+            self.connection = _UnixHTTPConnection(unix_socket, timeout=timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method, url, body=None):
+        self.connection.request(method, url, body=body)
+        response = self.connection.getresponse()
+        payload = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f"{response.status}: {payload.get('error')}")
+        return payload
+
+    def recognize(self, audio, top_k=DEFAULT_TOP_K):
+        """
+        :param audio: Audio file path or its bytes.
+        :return: {"matches": [{"name", "similarity", ...}, ...], "elapsed": seconds}
+        """
+        if isinstance(audio, str):
+            with open(audio, "rb") as f:
+                audio = f.read()
+        return self._request("POST", f"/recognize?top_k={top_k}", audio)
+
+    def health(self):
+        return self._request("GET", "/health")
+
+    def metrics(self):
+        """Prometheus text exposition of the service's metrics."""
+        self.connection.request("GET", "/metrics")
+        response = self.connection.getresponse()
+        text = response.read().decode()
+        if response.status != 200:
+            raise RuntimeError(f"{response.status}: {text}")
+        return text
+
+    def close(self):
+        self.connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve recognitions from an in-memory fingerprint index")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix-socket", help="Listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=None, help="Fingerprinting processes (default: all cores)")
+    parser.add_argument("--mode", choices=["features", "landmarks"], default="features")
+    parser.add_argument("--fingerprints", help="Fingerprint folder (default: ./fingerprints)")
+    parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE,
+                        help="IVF clusters probed per query on large catalogs "
+                             "(default: exhaustive scan, see python ivf_index.py for recall per nprobe)")
+    parser.add_argument("--trace", help="On shutdown, write a timeline of every request to this file "
+                                        "(Chrome trace format)")
+    args = parser.parse_args(argv)
+    if args.trace:
+        tracing.enable(args.trace)
+
+    generator = SpectrogramGenerator(None)
+    if args.fingerprints:
+        generator.output_path = args.fingerprints
+    service = RecognitionService(Recognizer(generator, match_mode=args.mode, nprobe=args.nprobe or None), workers=args.workers)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Headless batch recognition: identify audio files against the fingerprint catalog without the GUI.
+
+    python recognize.py some_folder/ other_file.wav --top-k 5 --format csv --workers 8
+
+Decoding and fingerprinting are spread over a process pool, the index is loaded once in
+this process, and results are streamed to stdout (or --output) as JSON lines or CSV.
+"""
+import argparse
+import contextlib
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from generate_spectrogram import SpectrogramGenerator, bounded_map
+from ivf_index import DEFAULT_NPROBE
+import tracing
+from metrics import REGISTRY
+from recognition import (Recognizer, fingerprint_file, match_to_dict, merge_worker_telemetry,
+                         reset_worker_telemetry, worker_telemetry)
+
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3')
+
+
+def find_audio_files(paths):
+    """Expand files and directories (recursively) into the list of audio files to recognize."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for file in sorted(files):
+                    if file.endswith(AUDIO_EXTENSIONS):
+                        yield os.path.join(root, file)
+        else:
+            yield path
+
+
+def _fingerprint_file(generator, landmarks, file_path):
+    """
+    Worker entry point: errors are returned so that one bad file does not stop the batch,
+    and the metrics and spans recorded by the worker go back with the fingerprint.
+    """
+    try:
+        return file_path, fingerprint_file(generator, file_path, landmarks), worker_telemetry()
+    except Exception as e:
+        return file_path, e, worker_telemetry()
+
+
+class JsonLinesWriter:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, file_path, matches, error=None):
+        record = {"file": file_path}
+        if error is not None:
+            record["error"] = error
+        else:
+            record["matches"] = [match_to_dict(match) for match in matches]
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+
+class CsvWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.writer = csv.writer(stream)
+        self.writer.writerow(["file", "rank", "name", "similarity", "error"])
+
+    def write(self, file_path, matches, error=None):
+        if error is not None:
+            self.writer.writerow([file_path, "", "", "", error])
+        for rank, match in enumerate(matches, 1):
+            self.writer.writerow([file_path, rank, match[0], f"{match[1]:.4f}", ""])
+        self.stream.flush()
+
+
+WRITERS = {"jsonl": JsonLinesWriter, "csv": CsvWriter}
+
+
+def recognize_files(recognizer, paths, writer, top_k=5, workers=None):
+    """
+    Recognize every audio file of paths and stream the top_k matches of each to writer.
+    :return: Number of files processed.
+    """
+    workers = workers or os.cpu_count() or 1
+    # Indexes stay in this process: workers only decode and fingerprint.
+    recognizer.index
+    landmarks = recognizer.uses_landmarks()
+
+    done = 0
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        jobs = ((recognizer.generator, landmarks, file_path) for file_path in find_audio_files(paths))
+        if workers == 1:
+            results = (_fingerprint_file(*job) for job in jobs)
+        else:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=reset_worker_telemetry))
+            results = bounded_map(pool, _fingerprint_file, jobs, max_pending=2 * workers)
+
+        for file_path, fingerprint, telemetry in results:
+            merge_worker_telemetry(telemetry)
+            if isinstance(fingerprint, Exception):
+                writer.write(file_path, [], error=str(fingerprint))
+            else:
+                writer.write(file_path, recognizer.find_similar_songs(fingerprint, top_k))
+            done += 1
+
+    elapsed = time.perf_counter() - start
+    print(f"Recognized {done} files in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.1f} files/s, "
+          f"{workers} workers)", file=sys.stderr)
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recognize audio files against the fingerprint catalog")
+    parser.add_argument("paths", nargs="+", help="Audio files or directories to scan recursively")
+    parser.add_argument("--top-k", type=int, default=5, help="Number of matches reported per file")
+    parser.add_argument("--format", choices=sorted(WRITERS), default="jsonl")
+    parser.add_argument("--output", help="Output file (default: stdout)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes (default: all cores, 1 to run in-process)")
+    parser.add_argument("--mode", choices=["features", "landmarks"], default="features")
+    parser.add_argument("--fingerprints", help="Fingerprint folder (default: ./fingerprints)")
+    parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE,
+                        help="IVF clusters probed per query on large catalogs "
+                             "(default: exhaustive scan, see python ivf_index.py for recall per nprobe)")
+    parser.add_argument("--metrics", help="Write the stage timings to this file (Prometheus text format)")
+    parser.add_argument("--trace", help="Write a timeline of every stage to this file (Chrome trace format)")
+    args = parser.parse_args(argv)
+    if args.trace:
+        tracing.enable(args.trace)
+
+    generator = SpectrogramGenerator(None)
+    if args.fingerprints:
+        generator.output_path = args.fingerprints
+    recognizer = Recognizer(generator, match_mode=args.mode, nprobe=args.nprobe or None)
+
+    with contextlib.ExitStack() as stack:
+        stream = stack.enter_context(open(args.output, "w", newline="")) if args.output else sys.stdout
+        recognize_files(recognizer, args.paths, WRITERS[args.format](stream),
+                        top_k=args.top_k, workers=args.workers)
+    if args.metrics:
+        REGISTRY.write(args.metrics)
+    if tracing.enabled():
+        tracing.write()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Entries are catalog rankings (one score per track), hence the modest default.
+DEFAULT_MAX_ENTRIES = 64
+DEFAULT_TTL = 600.0
+
+
+class AudioDigest:
+    """audio_digest computed incrementally over the consecutive blocks of a signal."""
+
+    def __init__(self):
+        self._hash = hashlib.blake2b(digest_size=16)
+
+    def update(self, block):
+        self._hash.update(np.ascontiguousarray(block).view(np.uint8))
+
+    def hexdigest(self, sr):
+        digest = self._hash.copy()
+        digest.update(str(sr).encode())
+        return digest.hexdigest()
+
+
+def audio_digest(y, sr):
+    """Content hash of decoded audio: the same samples give the same key whatever the file."""
+    digest = AudioDigest()
+    digest.update(y)
+    return digest.hexdigest(sr)
+
+
+class ResultCache:
+    """
+    LRU cache of recognition results, bounded in entries and age.
+
+    Keys must identify everything the result depends on (audio content, analysis
+    parameters, index version): entries are never updated, only evicted. Safe to share
+    between threads.
+    :param ttl: Lifetime of an entry in seconds, None to keep entries until evicted.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
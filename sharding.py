@@ -0,0 +1,278 @@
+"""
+Sharded feature catalog: N shard nodes hold a slice of the catalog each, a coordinator
+scatters every query to them and merges their top-k.
+
+    python sharding.py split fingerprints/ shards/ --shards 4
+    SHAZAM_SHARD_KEY=<secret> python sharding.py serve shards/shard_0 --port 9100
+    python sharding.py query shards/ song.wav --top-k 5 --check fingerprints/
+
+Tracks go to shard crc32(name) % N. Every shard remembers the catalog row of its tracks
+so that the merged order (similarity, then catalog row) is exactly the one of an
+exhaustive single-node Recognizer.find_similar_songs. A shard that does not answer
+within the timeout is left out of that query's result and reported as missing.
+Shards serve feature fingerprints only.
+
+Queries are pickled, so nodes and coordinator share a secret key (SHAZAM_SHARD_KEY)
+and a node refuses to start without one; `query` generates a key for the nodes it starts.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from collections import namedtuple
+from multiprocessing.connection import Client, Listener, wait
+
+import numpy as np
+
+from fingerprint_index import INDEX_FILENAME, FingerprintIndex, features_to_vector, fingerprint_code, load_index
+from similarity import CatalogScorer, top_k_indices
+
+
+SHARDS_FILENAME = "shards.json"
+ROWS_FILENAME = "rows.npy"
+DEFAULT_TIMEOUT = 2.0
+# Queries are pickled: nodes only accept clients knowing this secret key.
+AUTHKEY_ENV = "SHAZAM_SHARD_KEY"
+
+ScatterResult = namedtuple("ScatterResult", ["matches", "missing_shards"])
+
+
+def shard_of(name, n_shards):
+    return zlib.crc32(name.encode("utf-8")) % n_shards
+
+
+def shard_directory(root, shard):
+    return os.path.join(root, f"shard_{shard}")
+
+
+def authkey():
+    key = os.environ.get(AUTHKEY_ENV)
+    if not key:
+        raise RuntimeError(f"Set {AUTHKEY_ENV} to a secret shared by the shard nodes and their coordinator")
+    return key.encode()
+
+
+def split_catalog(index, output_dir, n_shards):
+    """
+    Write the shards of a FingerprintIndex: shard_<i>/index.npy and the catalog rows of its tracks.
+    :return: Shard directories.
+    """
+    assignment = np.array([shard_of(name, n_shards) for name in index.names()], dtype=np.int64)
+    directories = []
+    for shard in range(n_shards):
+        directory = shard_directory(output_dir, shard)
+        os.makedirs(directory, exist_ok=True)
+        rows = np.flatnonzero(assignment == shard)
+        FingerprintIndex(np.asarray(index.table[rows])).save(os.path.join(directory, INDEX_FILENAME))
+        np.save(os.path.join(directory, ROWS_FILENAME), rows)
+        directories.append(directory)
+    with open(os.path.join(output_dir, SHARDS_FILENAME), "w") as f:
+        json.dump({"shards": n_shards, "tracks": len(index)}, f)
+    return directories
+
+
+class ShardNode:
+    """One shard held in memory, answering (query vector, query code, top_k) requests."""
+
+    def __init__(self, directory):
+        self.index = FingerprintIndex.open(os.path.join(directory, INDEX_FILENAME))
+        self.rows = np.load(os.path.join(directory, ROWS_FILENAME))
+        self.scorer = CatalogScorer(self.index.features, self.index.phashes)
+
+    def query(self, query_vector, query_code, top_k=None):
+        """:return: [(similarity percentage, catalog row, name), ...] best first."""
+        percentages = np.minimum(self.scorer.score(query_vector, query_code) * 100, 100)
+        return [(float(percentages[i]), int(self.rows[i]), self.index.name(i))
+                for i in top_k_indices(percentages, top_k)]
+
+    def serve(self, host="127.0.0.1", port=0):
+        """Answer queries forever, one thread per coordinator connection."""
+        with Listener((host, port), authkey=authkey()) as listener:
+            print(f"listening on {listener.address[0]}:{listener.address[1]}", flush=True)
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as e:
+                    print(f"Rejected a connection: {e}", file=sys.stderr)
+                    continue
+                threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+    def _handle(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                    connection.send(self.query(*request))
+                except (EOFError, OSError):
+                    # Coordinator gone, or it gave up on this answer and closed the connection.
+                    return
+
+
+class ShardedCatalog:
+    """
+    Coordinator of a set of shard nodes.
+    :param addresses: (host, port) of every shard.
+    :param timeout: Seconds a query waits for the shards before leaving the late ones out.
+    """
+
+    def __init__(self, addresses, timeout=DEFAULT_TIMEOUT):
+        self.addresses = list(addresses)
+        self.timeout = timeout
+        self._connections = [None] * len(self.addresses)
+
+    def _connection(self, shard):
+        if self._connections[shard] is None:
+            self._connections[shard] = Client(self.addresses[shard], authkey=authkey())
+        return self._connections[shard]
+
+    def _drop(self, shard):
+        """Forget a shard's connection, reopened on the next query (a late answer would be read as the next one)."""
+        connection, self._connections[shard] = self._connections[shard], None
+        if connection is not None:
+            connection.close()
+
+    def query(self, fingerprint, top_k=None):
+        """
+        :return: ScatterResult of the [(track name, similarity percentage), ...] merged over
+                 the shards that answered in time, and the shards that did not.
+        """
+        request = (features_to_vector(fingerprint["features"], np.float64), fingerprint_code(fingerprint), top_k)
+        pending, missing = {}, []
+        for shard in range(len(self.addresses)):
+            try:
+                connection = self._connection(shard)
+                connection.send(request)
+                pending[connection] = shard
+            except (OSError, EOFError):
+                self._drop(shard)
+                missing.append(shard)
+
+        answers = []
+        deadline = time.monotonic() + self.timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for connection in wait(list(pending), remaining):
+                shard = pending.pop(connection)
+                try:
+                    answers.append(connection.recv())
+                except (OSError, EOFError):
+                    self._drop(shard)
+                    missing.append(shard)
+        for shard in pending.values():
+            self._drop(shard)
+            missing.append(shard)
+
+        # Each answer is sorted by (-similarity, catalog row): so is their merge.
+        merged = heapq.merge(*answers, key=lambda match: (-match[0], match[1]))
+        matches = [(name, similarity) for similarity, _, name in itertools.islice(merged, top_k)]
+        return ScatterResult(matches, sorted(missing))
+
+    def find_similar_songs(self, fingerprint, top_k=None):
+        return self.query(fingerprint, top_k).matches
+
+    def close(self):
+        for shard in range(len(self.addresses)):
+            self._drop(shard)
+
+
+def start_local_shards(shard_root):
+    """
+    Start one node subprocess per shard of shard_root, on free localhost ports.
+    :return: (processes, addresses)
+    """
+    with open(os.path.join(shard_root, SHARDS_FILENAME)) as f:
+        n_shards = json.load(f)["shards"]
+    if not os.environ.get(AUTHKEY_ENV):
+        os.environ[AUTHKEY_ENV] = os.urandom(16).hex()
+    env = dict(os.environ)
+
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve",
+                                   shard_directory(shard_root, shard), "--port", "0"],
+                                  stdout=subprocess.PIPE, text=True, env=env)
+                 for shard in range(n_shards)]
+    addresses = []
+    for process in processes:
+        line = process.stdout.readline()
+        if not line.startswith("listening on "):
+            for p in processes:
+                p.kill()
+            raise RuntimeError(f"Shard node failed to start: {line!r}")
+        host, _, port = line.split()[-1].rpartition(":")
+        addresses.append((host, int(port)))
+    return processes, addresses
+
+
+def stop_local_shards(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Split, serve and query a sharded fingerprint catalog")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    split = commands.add_parser("split", help="Split a fingerprint folder into shards")
+    split.add_argument("fingerprints")
+    split.add_argument("output")
+    split.add_argument("--shards", type=int, required=True)
+
+    serve = commands.add_parser("serve", help="Serve one shard")
+    serve.add_argument("directory")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=0, help="0 picks a free port, printed on startup")
+
+    query = commands.add_parser("query", help="Recognize files against local shard subprocesses")
+    query.add_argument("shards")
+    query.add_argument("paths", nargs="+")
+    query.add_argument("--top-k", type=int, default=5)
+    query.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT)
+    query.add_argument("--check", metavar="FINGERPRINTS",
+                       help="Compare every result with an exhaustive single-node search of this folder")
+    args = parser.parse_args(argv)
+
+    if args.command == "split":
+        directories = split_catalog(load_index(args.fingerprints), args.output, args.shards)
+        print(f"Split the catalog into {len(directories)} shards under {args.output}")
+    elif args.command == "serve":
+        if not os.environ.get(AUTHKEY_ENV):
+            parser.error(f"set {AUTHKEY_ENV} to a secret shared by the shard nodes and their coordinator")
+        ShardNode(args.directory).serve(args.host, args.port)
+    else:
+        from generate_spectrogram import SpectrogramGenerator
+        from recognition import Recognizer, fingerprint_file
+
+        generator = SpectrogramGenerator(None)
+        reference = None
+        if args.check:
+            generator.output_path = args.check
+            reference = Recognizer(generator, nprobe=None)
+
+        processes, addresses = start_local_shards(args.shards)
+        catalog = ShardedCatalog(addresses, args.timeout)
+        try:
+            for path in args.paths:
+                fingerprint = fingerprint_file(generator, path)
+                start = time.perf_counter()
+                result = catalog.query(fingerprint, args.top_k)
+                elapsed = time.perf_counter() - start
+                print(json.dumps({"file": path, "matches": result.matches,
+                                  "missing_shards": result.missing_shards, "elapsed": elapsed}))
+                if reference is not None and result.matches != reference.find_similar_songs(fingerprint, args.top_k):
+                    print(f"Mismatch with the single-node ranking for {path}", file=sys.stderr)
+        finally:
+            catalog.close()
+            stop_local_shards(processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import numpy as np
+
+from fingerprint_index import FEATURE_KEYS, fingerprint_code
+from perceptual_code import CODE_BITS, hamming_distances, hex_to_code
+
+
+FEATURE_WEIGHTS = {
+    "spectral_centroid_mean": 0.15,
+    "spectral_bandwidth_mean": 0.10,
+    "spectral_contrast_mean": 0.10,
+    "spectral_rolloff_mean": 0.10,
+    "tonnetz_mean": 0.15,
+    "zero_crossing_rate_mean": 0.10
+}
+for i in range(13):
+    FEATURE_WEIGHTS[f'mfcc_{i}_mean'] = 0.02 * (1.25 if i == 0 else 1)
+
+WEIGHT_VECTOR = np.array([FEATURE_WEIGHTS.get(key, 0.05) for key in FEATURE_KEYS])
+PHASH_WEIGHT = 0.10
+
+
+def cosine_similarity(vec1, vec2):
+    """
+    Similarity between two features.
+    For scalars, a difference-based similarity is used instead of the cosine.
+    """
+    if isinstance(vec1, (int, float)) and isinstance(vec2, (int, float)):
+        return 1 - abs(vec1 - vec2) / (abs(vec1) + abs(vec2) + 1e-8)
+
+    vec1 = np.array(vec1)
+    vec2 = np.array(vec2)
+    if vec1.ndim > 1:
+        vec1 = vec1.flatten()
+    if vec2.ndim > 1:
+        vec2 = vec2.flatten()
+    return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2) + 1e-8)
+
+
+def hamming_distance(code1, code2):
+    """
+    Normalized similarity (between 0 and 1) of two perceptual codes (uint64 words or hex).
+    """
+    if isinstance(code1, str):
+        code1 = hex_to_code(code1)
+    if isinstance(code2, str):
+        code2 = hex_to_code(code2)
+    return 1 - int(hamming_distances(code1, code2)) / CODE_BITS
+
+
+def compute_similarity(fingerprint1, fingerprint2):
+    """Weighted similarity of two fingerprint dicts (reference per-pair implementation)."""
+    similarities = []
+
+    for key in FEATURE_KEYS:
+        if key in fingerprint1["features"] and key in fingerprint2["features"]:
+            sim = cosine_similarity(fingerprint1["features"][key], fingerprint2["features"][key])
+            similarities.append(FEATURE_WEIGHTS.get(key, 0.05) * sim)
+
+    if "phash" in fingerprint1 and "phash" in fingerprint2:
+        phash_sim = hamming_distance(fingerprint_code(fingerprint1), fingerprint_code(fingerprint2))
+        similarities.append(PHASH_WEIGHT * phash_sim)
+
+    return sum(similarities)
+
+
+def score_catalog(query_vector, features, query_phash=None, phashes=None):
+    """
+    Score one query against a whole catalog with the compute_similarity formula.
+
+    :param query_vector: Query features in FEATURE_KEYS order (NaN for missing features).
+    :param features: (N, len(FEATURE_KEYS)) catalog matrix, NaN for missing features.
+    :param query_phash: Query perceptual code (uint64 words or hex), or None to skip the phash term.
+    :param phashes: (N, CODE_WORDS) uint64 array of catalog codes.
+    :return: float64 array of the N weighted similarities.
+    """
+    return CatalogScorer(features, phashes).score(query_vector, query_phash)
+
+
+class CatalogScorer:
+    """
+    Vectorized compute_similarity of one query against a whole catalog.
+
+    The catalog is laid out once (one contiguous float64 row per feature, contiguous
+    perceptual codes) so that repeated queries only pay for a few broadcasts.
+    """
+
+    def __init__(self, features, phashes=None):
+        self.columns = np.ascontiguousarray(np.asarray(features).T, dtype=np.float64)
+        self.abs_columns = np.abs(self.columns)
+        self.nan_columns = np.isnan(self.columns).any(axis=1)
+        self.size = self.columns.shape[1]
+
+        self.phashes = None
+        if phashes is not None and len(phashes):
+            self.phashes = np.ascontiguousarray(phashes, dtype="<u8")
+
+    def __len__(self):
+        return self.size
+
+    def score(self, query_vector, query_phash=None, rows=None):
+        """
+        :param rows: Catalog rows to score (index array or slice), all of them by default.
+        :return: Scores of the selected rows, in the same order.
+        """
+        query = np.asarray(query_vector, dtype=np.float64)
+        columns, abs_columns = self.columns, self.abs_columns
+        if rows is not None:
+            columns, abs_columns = columns[:, rows], abs_columns[:, rows]
+
+        # Accumulate feature by feature so the sum follows the same order as compute_similarity.
+        total = np.zeros(columns.shape[1])
+        for j, (value, weight) in enumerate(zip(query, WEIGHT_VECTOR)):
+            if np.isnan(value):
+                continue
+            sims = 1 - np.abs(value - columns[j]) / (abs(value) + abs_columns[j] + 1e-8)
+            if self.nan_columns[j]:
+                sims = np.nan_to_num(sims, nan=0.0)
+            total += weight * sims
+
+        if query_phash is not None and self.phashes is not None:
+            phashes = self.phashes if rows is None else self.phashes[rows]
+            total += PHASH_WEIGHT * phash_similarity(query_phash, phashes)
+
+        return total
+
+
+def top_k_indices(scores, k=None):
+    """
+    Indices of the k highest scores, best first, in the order of a stable descending
+    argsort (ties keep index order) but selected with a linear-time partition.
+    """
+    n = len(scores)
+    if k is None or k >= n:
+        return np.argsort(-scores, kind="stable")
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    kth = np.partition(scores, n - k)[n - k]
+    candidates = np.flatnonzero(scores >= kth)
+    return candidates[np.argsort(-scores[candidates], kind="stable")[:k]]
+
+
+def phash_similarity(query_phash, phashes):
+    """Vectorized hamming_distance of one perceptual code against an array of codes (XOR + popcount)."""
+    if isinstance(query_phash, str):
+        query_phash = hex_to_code(query_phash)
+    return 1 - hamming_distances(query_phash, phashes) / CODE_BITS
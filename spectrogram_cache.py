@@ -0,0 +1,75 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def cache_key(content_sha256, *params):
+    """Key of a derived array: content hash of the source file plus every parameter it depends on."""
+    return hashlib.sha256(repr((content_sha256,) + params).encode()).hexdigest()
+
+
+class SpectrogramCache:
+    """
+    Content-addressed store of analysis arrays (dB mel spectrograms, landmarks).
+
+    Every entry is a .npy file named after its key and memory-mapped on read, so a
+    re-analysis only pages in what it touches. Reads bump the file mtime, and evict()
+    deletes the least recently used entries until the total fits in max_bytes. Writes
+    are atomic, so concurrent worker processes can share the directory.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return array
+
+    def put(self, key, array):
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+        return path
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache fits its byte budget.
+        :return: Number of bytes freed.
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".npy"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for _, size, path in sorted(entries):
+            if total - freed <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                freed += size
+            except FileNotFoundError:
+                pass
+        return freed
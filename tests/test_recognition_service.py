@@ -0,0 +1,92 @@
+import io
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import soundfile as sf
+
+from benchmark import AUDIO_SAMPLE_RATE, synthetic_audio, synthetic_catalog
+from fingerprint_index import INDEX_FILENAME
+from recognition_service import RecognitionClient
+
+
+SERVICE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "recognition_service.py")
+TRACKS = 50
+
+
+def wav_bytes(seed, duration=20.0):
+    f = io.BytesIO()
+    sf.write(f, synthetic_audio("noise_mix", duration, seed=seed), AUDIO_SAMPLE_RATE, format="WAV")
+    return f.getvalue()
+
+
+def decode_count(client):
+    for line in client.metrics().splitlines():
+        if line.startswith('shazam_stage_seconds_count{stage="decode"}'):
+            return int(float(line.split()[-1]))
+    return 0
+
+
+@pytest.fixture
+def service(tmp_path):
+    fingerprints = tmp_path / "fingerprints"
+    fingerprints.mkdir()
+    synthetic_catalog(TRACKS).save(str(fingerprints / INDEX_FILENAME))
+    socket_path = str(tmp_path / "service.sock")
+    process = subprocess.Popen([sys.executable, SERVICE, "--unix-socket", socket_path,
+                                "--fingerprints", str(fingerprints), "--workers", "1"])
+    try:
+        deadline = time.monotonic() + 60
+        while not os.path.exists(socket_path):
+            assert process.poll() is None, "the service exited on startup"
+            assert time.monotonic() < deadline, "the service did not start"
+            time.sleep(0.1)
+        yield socket_path, fingerprints
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def test_recognize_round_trip(service):
+    client = RecognitionClient(unix_socket=service[0])
+    try:
+        assert client.health() == {"status": "ok", "tracks": TRACKS, "in_flight": 0}
+        result = client.recognize(wav_bytes(seed=0), top_k=3)
+        assert len(result["matches"]) == 3
+        assert all(match["name"].startswith("synthetic_") for match in result["matches"])
+        similarities = [match["similarity"] for match in result["matches"]]
+        assert similarities == sorted(similarities, reverse=True)
+    finally:
+        client.close()
+
+
+def test_concurrent_identical_uploads_share_one_job(service):
+    audio = wav_bytes(seed=1)
+    clients = [RecognitionClient(unix_socket=service[0]) for _ in range(4)]
+    try:
+        before = decode_count(clients[0])
+        with ThreadPoolExecutor(len(clients)) as pool:
+            results = list(pool.map(lambda client: client.recognize(audio)["matches"], clients))
+        assert all(matches == results[0] for matches in results)
+        assert decode_count(clients[0]) - before == 1
+        assert clients[0].health()["in_flight"] == 0
+    finally:
+        for client in clients:
+            client.close()
+
+
+def test_error_statuses(service):
+    socket_path, fingerprints = service
+    client = RecognitionClient(unix_socket=socket_path)
+    try:
+        with pytest.raises(RuntimeError, match="^400: could not decode"):
+            client.recognize(b"not audio at all")
+        # A broken catalog is the service's fault, not the upload's.
+        (fingerprints / INDEX_FILENAME).write_bytes(b"truncated")
+        with pytest.raises(RuntimeError, match="^500: "):
+            client.recognize(wav_bytes(seed=2, duration=3.0))
+    finally:
+        client.close()
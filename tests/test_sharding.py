@@ -0,0 +1,91 @@
+import os
+import signal
+
+import numpy as np
+import pytest
+
+from benchmark import synthetic_catalog
+from fingerprint_index import INDEX_FILENAME
+from generate_spectrogram import SpectrogramGenerator
+from recognition import Recognizer
+from sharding import (AUTHKEY_ENV, ShardedCatalog, shard_of, split_catalog, start_local_shards,
+                      stop_local_shards)
+
+
+N_SHARDS = 3
+TOP_K = 10
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    index = synthetic_catalog(600, seed=1)
+    fingerprints = tmp_path / "fingerprints"
+    fingerprints.mkdir()
+    index.save(str(fingerprints / INDEX_FILENAME))
+    split_catalog(index, str(tmp_path / "shards"), N_SHARDS)
+
+    generator = SpectrogramGenerator(None)
+    generator.output_path = str(fingerprints)
+    return index, Recognizer(generator, nprobe=None), str(tmp_path / "shards")
+
+
+@pytest.fixture
+def nodes(catalog, monkeypatch):
+    monkeypatch.setenv(AUTHKEY_ENV, os.urandom(16).hex())
+    processes, addresses = start_local_shards(catalog[2])
+    yield processes, addresses
+    for process in processes:
+        if process.poll() is None:
+            os.kill(process.pid, signal.SIGCONT)
+    stop_local_shards(processes)
+
+
+def queries(index, count=8, seed=2):
+    """Catalog fingerprints with their features nudged, so that ties between tracks are rare."""
+    rng = np.random.default_rng(seed)
+    for i in rng.choice(len(index), count, replace=False):
+        fingerprint = index.fingerprint(i)
+        fingerprint["features"] = {key: value * rng.uniform(0.95, 1.05)
+                                   for key, value in fingerprint["features"].items()}
+        yield fingerprint
+
+
+def test_scatter_gather_matches_single_node(catalog, nodes):
+    index, recognizer, _ = catalog
+    sharded = ShardedCatalog(nodes[1])
+    try:
+        for fingerprint in queries(index):
+            result = sharded.query(fingerprint, TOP_K)
+            assert result.missing_shards == []
+            assert result.matches == recognizer.find_similar_songs(fingerprint, TOP_K)
+    finally:
+        sharded.close()
+
+
+@pytest.mark.parametrize("failure", [signal.SIGSTOP, signal.SIGKILL])
+def test_unresponsive_shard_is_reported_missing(catalog, nodes, failure):
+    index, recognizer, _ = catalog
+    processes, addresses = nodes
+    fingerprint = next(queries(index))
+    sharded = ShardedCatalog(addresses, timeout=0.5)
+    try:
+        sharded.query(fingerprint, TOP_K)
+        os.kill(processes[1].pid, failure)
+        if failure == signal.SIGKILL:
+            processes[1].wait()
+
+        result = sharded.query(fingerprint, TOP_K)
+        assert result.missing_shards == [1]
+        # What the other shards answered is still merged in order.
+        expected = [match for match in recognizer.find_similar_songs(fingerprint)
+                    if shard_of(match[0], N_SHARDS) != 1][:TOP_K]
+        assert result.matches == expected
+
+        if failure == signal.SIGSTOP:
+            # The late answer is dropped with its connection: the shard is back on the next query.
+            os.kill(processes[1].pid, signal.SIGCONT)
+            result = sharded.query(fingerprint, TOP_K)
+            assert result.missing_shards == []
+            assert result.matches == recognizer.find_similar_songs(fingerprint, TOP_K)
+    finally:
+        sharded.close()
@@ -0,0 +1,124 @@
+"""
+Opt-in timeline of nested spans, written in the Chrome trace event format.
+
+    SHAZAM_TRACE=trace.json python main.py
+    python recognize.py songs/ --trace trace.json
+
+Open the file in chrome://tracing or https://ui.perfetto.dev: every process and thread
+gets its own track, so the stages run by pool workers show up next to the ranking done
+by the parent. While tracing is off, span() returns a shared no-op context manager.
+"""
+import contextlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+
+TRACE_ENV = "SHAZAM_TRACE"
+
+_NO_SPAN = contextlib.nullcontext()
+_lock = threading.Lock()
+_events = None
+_threads = {}
+
+
+def enable(path=None):
+    """
+    Start recording spans in this process and in the worker processes it starts.
+    :param path: File written by write(), also passed to workers through the environment.
+    """
+    global _events
+    if path:
+        os.environ[TRACE_ENV] = path
+    with _lock:
+        if _events is None:
+            _events = []
+
+
+def disable():
+    global _events
+    with _lock:
+        _events = None
+        _threads.clear()
+
+
+def enabled():
+    return _events is not None
+
+
+def span(name, **args):
+    """Context manager recording one complete event, with args shown in the trace viewer."""
+    if _events is None:
+        return _NO_SPAN
+    return _span(name, args)
+
+
+@contextlib.contextmanager
+def _span(name, args):
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter_ns() - start
+        event = {"name": name, "ph": "X", "ts": start / 1000, "dur": duration / 1000,
+                 "pid": os.getpid(), "tid": threading.get_native_id()}
+        if args:
+            event["args"] = args
+        with _lock:
+            if _events is not None:
+                _events.append(event)
+                _threads.setdefault((event["pid"], event["tid"]), threading.current_thread().name)
+
+
+def drain():
+    """Events recorded since the last drain, with the names of their process and threads."""
+    global _events
+    with _lock:
+        if _events is None:
+            return []
+        events, _events = _events, []
+        threads = dict(_threads)
+        _threads.clear()
+    process = multiprocessing.current_process().name
+    metadata = []
+    for pid in sorted({pid for pid, _ in threads}):
+        metadata.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": process}})
+    for (pid, tid), thread in threads.items():
+        metadata.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}})
+    return metadata + events
+
+
+def reset():
+    """Forget the events a forked worker inherited from its parent."""
+    drain()
+
+
+def merge(events):
+    """Add events drained in another process."""
+    with _lock:
+        if _events is not None:
+            _events.extend(events)
+
+
+def write(path=None):
+    """Write every event recorded so far (and merged from workers) as a Chrome trace file."""
+    path = path or os.environ.get(TRACE_ENV)
+    events, seen = [], set()
+    for event in drain():
+        if event["ph"] == "M":
+            key = (event["name"], event["pid"], event.get("tid"))
+            if key in seen:
+                continue
+            seen.add(key)
+        events.append(event)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    os.replace(tmp_path, path)
+    return path
+
+
+if os.environ.get(TRACE_ENV):
+    enable()